@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+    bench
+    ~~~~~
+
+    Small benchmarks for the request handling hot paths of flask and the
+    werkzeug locals.  Run it with ``python bench.py``.
+"""
+from __future__ import with_statement
+import gc
+import sys
+import time
+import threading
+
+import flask
+import local
+
+
+def _timeit(func, number):
+    gc.collect()
+    start = time.time()
+    for _ in xrange(number):
+        func()
+    return (time.time() - start) / number
+
+
+def _allocated():    # Python 3 上为已分配的内存块数，Python 2 上退而使用 gc 跟踪的对象数
+    if hasattr(sys, 'getallocatedblocks'):
+        return sys.getallocatedblocks()
+    return len(gc.get_objects())
+
+
+_marks = []    # 视图函数执行时的 _allocated()
+
+
+def _allocations_per_request(func, number):
+    """Runs a full request ``number`` times and returns the average number
+    of objects allocated from the start of the request until its view
+    function runs, where everything the request needs has been created.
+    """
+    func()    # 预热，排除第一次请求时的缓存和延迟导入
+    gc.collect()
+    gc.disable()    # 避免垃圾回收改变计数
+    try:
+        total = 0
+        for _ in xrange(number):
+            del _marks[:]
+            before = _allocated()
+            func()
+            total += _marks[0] - before
+    finally:
+        gc.enable()
+    return float(total) / number
+
+
+def _make_app(lazy):
+    app = flask.Flask(__name__)
+    app.secret_key = 'benchmark secret'
+    app.lazy_request_context = lazy
+
+    @app.route('/json')
+    def json_view():
+        _marks.append(_allocated())
+        return '{"ok": true}'
+
+    @app.route('/login')
+    def login():
+        flask.session['user'] = 42
+        return 'ok'
+    return app
+
+
+def bench_request_context(number=10000):
+    """Compares eager and lazy request contexts for a view that never
+    touches the session or :data:`~flask.g`.  The request carries a
+    signed session cookie so the eager context has to verify it.  Both
+    the time and the allocations are measured over a full WSGI call.
+    """
+    cookie = _make_app(False).test_client().get('/login') \
+        .headers['Set-Cookie'].split(';')[0]
+    print 'request context (%d requests, session cookie sent):' % number
+    for lazy in (False, True):
+        app = _make_app(lazy)
+        environ = flask.create_environ('/json', headers={'Cookie': cookie})
+
+        def request():
+            return app(dict(environ), lambda status, headers: None)
+
+        print '  %-6s %8.2f us/request  %6.1f %s/request' % (
+            lazy and 'lazy' or 'eager',
+            _timeit(request, number) * 1e6,
+            _allocations_per_request(request, 1000),
+            hasattr(sys, 'getallocatedblocks') and 'blocks' or 'objects')
+
+
+class _Request(object):
+    method = 'GET'
+
+
+def bench_local_backends(threads=4, number=200000):
+    """Reads an attribute through a :class:`~local.LocalProxy` from
+    several threads at once for the lock based and the lock free
+    implementation of :class:`~local.Local`.
+    """
+    print 'LocalProxy attribute access (%d threads x %d reads):' % (
+        threads, number)
+    for name, cls in (('lock', local.LockedLocal),
+                      ('context', local.ContextLocal)):
+        loc = cls()
+        proxy = loc('request')
+
+        def worker():
+            loc.request = _Request()
+            for _ in xrange(number):
+                proxy.method
+            local.release_local(loc)
+
+        workers = [threading.Thread(target=worker) for _ in xrange(threads)]
+        gc.collect()
+        start = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.time() - start
+        print '  %-8s %8.3f s  %8.3f us/read' % (
+            name, elapsed, elapsed / (threads * number) * 1e6)
+
+
+def bench_proxy_cache(number=1000000):
+    """Reads an attribute of the topmost stack item through a plain
+    :class:`~local.LocalProxy` and through a
+    :class:`~local.CachedLocalProxy`, with the backend selected by
+    ``WERKZEUG_LOCAL_BACKEND`` (the lock based one by default).
+    """
+    stack = local.LocalStack()
+    ctx = _Request()
+    ctx.request = _Request()
+    proxies = (
+        ('plain', local.LocalProxy(lambda: stack.top.request)),
+        ('cached', local.CachedLocalProxy(stack, 'request')),
+    )
+    print '%d proxied attribute reads (%s backend):' % (
+        number, local.LOCAL_BACKEND)
+    stack.push(ctx)
+    try:
+        for name, proxy in proxies:
+            gc.collect()
+            start = time.time()
+            for _ in xrange(number):
+                proxy.method
+            elapsed = time.time() - start
+            print '  %-8s %8.3f s  %8.3f us/read' % (
+                name, elapsed, elapsed / number * 1e6)
+    finally:
+        stack.pop()
+
+
+if __name__ == '__main__':
+    bench_request_context()
+    bench_local_backends()
+    bench_proxy_cache()
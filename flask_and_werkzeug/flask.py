@@ -12,13 +12,14 @@
 from __future__ import with_statement
 import os
 import sys
+from collections import OrderedDict
 
-from threading import local
+from threading import local, Lock
 from jinja2 import Environment, PackageLoader, FileSystemLoader
 from werkzeug import Request as RequestBase, Response as ResponseBase, \
      LocalStack, LocalProxy, create_environ, cached_property, \
      SharedDataMiddleware
-from werkzeug.routing import Map, Rule
+from werkzeug.routing import Map, Rule, RequestSlash
 from werkzeug.exceptions import HTTPException, InternalServerError
 from werkzeug.contrib.securecookie import SecureCookie
 
@@ -27,6 +28,14 @@ from werkzeug.contrib.securecookie import SecureCookie
 from werkzeug import abort, redirect
 from jinja2 import Markup, escape
 
+# the context locals of the local module next to this file replace the
+# ones of werkzeug if it can be imported.  Its proxies cache the resolved
+# context objects until the request stack changes.
+try:
+    from local import LocalStack, LocalProxy, CachedLocalProxy
+except ImportError:
+    CachedLocalProxy = None
+
 # use pkg_resource if that works, otherwise fall back to cwd.  The
 # current working directory is generally not reliable with the notable
 # exception of google appengine.
@@ -68,21 +77,132 @@ class _RequestGlobals(object):
     pass
 
 
+class _CompiledRouter(object):    # 预编译的路由表，用于加速 url 匹配
+    """A precompiled view of a :class:`~werkzeug.routing.Map` that is used
+    by :meth:`Flask.match_request` if :attr:`Flask.use_compiled_router` is
+    enabled.  Rules without variable parts end up in a hash table keyed by
+    their path, rules with variable parts are stored in a prefix trie keyed
+    by the static path segments in front of the first variable.  Only the
+    rules found that way are matched, in the same order the map would try
+    them.  The results of successful matches are remembered in a small LRU
+    cache keyed by ``(method, path)``.
+
+    Anything that is not a plain successful match (redirects, missing
+    slashes, 404 and 405 errors) is left to the regular URL adapter so
+    that the behavior is exactly the one of the map.
+    """
+
+    def __init__(self, url_map, cache_size=1000):
+        url_map.update()    # 保证 map 中的 rule 已经按照匹配顺序排序
+        self.cache_size = cache_size
+        self._cache = OrderedDict()    # LRU 缓存: (method, path) -> (endpoint, view_args)
+        self._lock = Lock()
+        self.static = {}    # 静态 url 的 hash 表: path -> [(order, rule)]
+        self.trie = ({}, [])    # 前缀树的节点为 (children, [(order, rule)])
+        self.enabled = True
+        for order, rule in enumerate(url_map._rules):
+            if rule.build_only:
+                continue
+            if rule.subdomain != url_map.default_subdomain:
+                # subdomain matching depends on the server name, leave
+                # that to the url adapter.
+                self.enabled = False
+                return
+            if not rule.arguments:    # 没有变量的 rule 直接存入 hash 表
+                self.static.setdefault(rule.rule, []).append((order, rule))
+                continue
+            node = self.trie
+            # only full segments in front of the first variable are static
+            for segment in rule.rule[:rule.rule.index('<')].split('/')[1:-1]:
+                node = node[0].setdefault(segment, ({}, []))
+            node[1].append((order, rule))
+
+    def candidates(self, path):    # 找出所有可能匹配 path 的 rule
+        """Returns the rules that could match `path` in map order."""
+        rv = list(self.static.get(path, ()))
+        if not path.endswith('/'):    # 以 / 结尾的 rule 会触发重定向
+            rv.extend(self.static.get(path + '/', ()))
+        node = self.trie
+        rv.extend(node[1])
+        for segment in path.split('/')[1:]:
+            node = node[0].get(segment)
+            if node is None:
+                break
+            rv.extend(node[1])
+        rv.sort()
+        return [rule for order, rule in rv]
+
+    def match(self, method, path):
+        """Returns ``(endpoint, view_args)`` for the given method and path
+        or `None` if the regular URL adapter has to be used.
+        """
+        if not self.enabled:
+            return None
+        key = (method, path)
+        with self._lock:
+            rv = self._cache.get(key)
+            if rv is not None:
+                self._cache[key] = self._cache.pop(key)    # 移动到 LRU 的末尾
+                return rv[0], dict(rv[1])
+        match_path = u'|/' + path.lstrip('/')
+        for rule in self.candidates(path):
+            try:
+                view_args = rule.match(match_path)
+            except RequestSlash:
+                return None
+            if view_args is None:
+                continue
+            if rule.methods is not None and method not in rule.methods:
+                continue
+            if rule.redirect_to is not None:
+                return None
+            with self._lock:
+                self._cache[key] = (rule.endpoint, view_args)
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)    # 删除最久未使用的结果
+            return rule.endpoint, dict(view_args)
+
+
 class _RequestContext(object):    # 请求上下文
     """The request context contains all request relevant information.  It is
     created at the beginning of the request and pushed to the
     `_request_ctx_stack` and removed at the end of it.  It will create the
     URL adapter and request object for the WSGI environment provided.
+
+    If :attr:`Flask.lazy_request_context` is enabled the URL adapter, the
+    session and the request globals are only created the first time they
+    are accessed.
     """
 
     def __init__(self, app, environ):    # 请求上下文，实例化时 app 和 environ
         self.app = app
-        self.url_adapter = app.url_map.bind_to_environ(environ)    #  通过 environ 中的 url 找到对应的 view function
         self.request = app.request_class(environ)    # 通过 environ 来实例化 request_class
-        self.session = app.open_session(self.request)    # 通过实例化的 request 对象来 open 一个 session
-        self.g = _RequestGlobals()    # app.g 为 _RequestGlobals 对象
+        if not app.lazy_request_context:    # 非 lazy 模式下，直接创建 url_adapter， session 和 g
+            self.url_adapter = app.url_map.bind_to_environ(environ)    #  通过 environ 中的 url 找到对应的 view function
+            self.session = app.open_session(self.request)    # 通过实例化的 request 对象来 open 一个 session
+            self.g = _RequestGlobals()    # app.g 为 _RequestGlobals 对象
         self.flashes = None
 
+    # lazy 模式下，以下属性在第一次被访问时才会创建，并缓存在实例的 __dict__ 中
+    @cached_property
+    def url_adapter(self):
+        return self.app.url_map.bind_to_environ(self.request.environ)
+
+    @cached_property
+    def session(self):
+        return self.app.open_session(self.request)
+
+    @cached_property
+    def g(self):
+        return _RequestGlobals()
+
+    @property
+    def opened_session(self):    # 返回已经创建的 session， 不会触发 session 的创建
+        """The session if it was opened for this request, `None`
+        otherwise.  Unlike :attr:`session` this never opens the session.
+        """
+        return self.__dict__.get('session')
+
     def __enter__(self):    #  __enter__ 方法，用于 with_statement，在进入上下文时，会将实例化的 _RequestContext push 到 _request_ctx_stack 中
         _request_ctx_stack.push(self)
 
@@ -211,6 +331,23 @@ class Flask(object):
     #: The secure cookie uses this for the name of the session cookie
     session_cookie_name = 'session'
 
+    #: if set to `True` the URL map is compiled into a hash table and a
+    #: prefix trie on the first request and recent matches are cached.
+    #: Requests that do not resolve to a view are still handled by the
+    #: regular URL adapter.  If you add rules to :attr:`url_map` directly
+    #: instead of using :meth:`add_url_rule` you have to call
+    #: :meth:`invalidate_router` afterwards.
+    use_compiled_router = False
+
+    #: the number of ``(method, path)`` matches the compiled router keeps.
+    compiled_router_cache_size = 1000
+
+    #: if set to `True` the URL adapter, the session and :data:`g` are
+    #: created on first access instead of at the beginning of each request.
+    #: Requests that never touch the session skip loading (and saving)
+    #: the session cookie entirely.
+    lazy_request_context = False
+
     #: options that are passed directly to the Jinja2 environment
     jinja_options = dict(
         autoescape=True,
@@ -269,6 +406,10 @@ class Flask(object):
 
         self.url_map = Map()    # url map
 
+        #: the compiled router, created on the first request if
+        #: :attr:`use_compiled_router` is enabled.
+        self._router = None
+
         if self.static_path is not None:
             self.url_map.add(Rule(self.static_path + '/<filename>',
                                   build_only=True, endpoint='static'))
@@ -419,6 +560,14 @@ class Flask(object):
         options['endpoint'] = endpoint
         options.setdefault('methods', ('GET',))
         self.url_map.add(Rule(rule, **options))    # 在 url map 中新增一条对应 Rule
+        self.invalidate_router()
+
+    def invalidate_router(self):    # 丢弃预编译的路由表，下一次请求时重新编译
+        """Throws away the compiled router so that it is rebuilt from
+        :attr:`url_map` on the next request.  This is called automatically
+        by :meth:`add_url_rule`.
+        """
+        self._router = None
 
     def route(self, rule, **options):    # 关联 url 和 view function 的装饰器
         """A decorator that is used to register a view function for a
@@ -534,7 +683,15 @@ class Flask(object):
         stores the endpoint and view arguments on the request object
         is successful, otherwise the exception is stored.
         """
-        rv = _request_ctx_stack.top.url_adapter.match()
+        rv = None
+        if self.use_compiled_router:
+            router = self._router
+            if router is None:
+                self._router = router = _CompiledRouter(
+                    self.url_map, self.compiled_router_cache_size)
+            rv = router.match(request.method, request.path)
+        if rv is None:    # 预编译的路由表无法处理时，交给 url adapter 来匹配
+            rv = _request_ctx_stack.top.url_adapter.match()
         request.endpoint, request.view_args = rv
         return rv
 
@@ -607,7 +764,7 @@ class Flask(object):
         :return: a new response object or the same, has to be an
                  instance of :attr:`response_class`.
         """
-        session = _request_ctx_stack.top.session
+        session = _request_ctx_stack.top.opened_session
         if session is not None:
             self.save_session(session, response)
         for handler in self.after_request_funcs:
@@ -666,6 +823,11 @@ current_app = LocalProxy(lambda: _request_ctx_stack.top.app)    # current_app 
 request = LocalProxy(lambda: _request_ctx_stack.top.request)    # request 为  _request_ctx_stack 中栈顶的 request 对象的 request 属性的代理
 session = LocalProxy(lambda: _request_ctx_stack.top.session)    # session 为  _request_ctx_stack 中栈顶的 request 对象的 session 属性的代理
 g = LocalProxy(lambda: _request_ctx_stack.top.g)    # g 为  _request_ctx_stack 中栈顶的 request 对象的 g 属性的代理
+if CachedLocalProxy is not None:    # 在一次请求内缓存代理对象的解析结果
+    current_app = CachedLocalProxy(_request_ctx_stack, 'app')
+    request = CachedLocalProxy(_request_ctx_stack, 'request')
+    session = CachedLocalProxy(_request_ctx_stack, 'session')
+    g = CachedLocalProxy(_request_ctx_stack, 'g')
 
 """
 example1:  此示例基于 0.10.1 版本， _request_ctx_stack, _app_ctx_stack 分为两个不同的 LocalStack
@@ -5,9 +5,16 @@
 
     This module implements context-local objects.
 
+    Two implementations of :class:`Local` exist.  The default one keeps the
+    data of all contexts in one dictionary guarded by a lock, the lock free
+    one (:class:`ContextLocal`) is selected by setting the environment
+    variable ``WERKZEUG_LOCAL_BACKEND`` to ``context`` before this module
+    is imported.
+
     :copyright: (c) 2010 by the Werkzeug Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import os
 try:
     from greenlet import getcurrent as get_current_greenlet
 except ImportError: # pragma: no cover
@@ -21,7 +28,15 @@ except ImportError: # pragma: no cover
 try:
     from thread import get_ident as get_current_thread, allocate_lock
 except ImportError: # pragma: no cover
-    from dummy_thread import get_ident as get_current_thread, allocate_lock
+    try:
+        from _thread import get_ident as get_current_thread, allocate_lock
+    except ImportError:
+        from dummy_thread import get_ident as get_current_thread, \
+             allocate_lock
+try:
+    from contextvars import ContextVar
+except ImportError: # pragma: no cover
+    ContextVar = None
 
 from werkzeug.wsgi import ClosingIterator
 from werkzeug._internal import _patch_wrapper
@@ -35,6 +50,12 @@ if get_current_greenlet is int: # pragma: no cover
 else:
     get_ident = lambda: (get_current_thread(), get_current_greenlet())
 
+#: the :class:`Local` implementation that is used, either ``'lock'`` or
+#: ``'context'``.  See :class:`ContextLocal` for the latter.
+LOCAL_BACKEND = os.environ.get('WERKZEUG_LOCAL_BACKEND', 'lock')
+if LOCAL_BACKEND not in ('lock', 'context'): # pragma: no cover
+    raise ValueError('unknown local backend %r' % LOCAL_BACKEND)
+
 
 def release_local(local):
     """Releases the contents of the local for the current context.
@@ -134,6 +155,90 @@ class Local(object):    # Local 对象
             self.__lock__.release() # 释放锁
 
 
+class ContextLocal(object):    # 无锁的 Local 对象
+    """A :class:`Local` that does not need a lock.  If :mod:`contextvars` is
+    available the data is kept in a context variable, so every thread,
+    greenlet and asyncio task sees its own data.  The stored dictionary is
+    never modified in place but replaced, which keeps tasks that inherited
+    a copy of the context from seeing each other's changes.
+
+    Without :mod:`contextvars` the data is kept per context identifier like
+    in :class:`Local`, relying on the dictionary operations being atomic
+    instead of taking a lock.
+    """
+    __slots__ = ('__storage__',)
+
+    def __call__(self, proxy):
+        """Create a proxy for a name."""
+        return LocalProxy(self, proxy)
+
+    # 根据 contextvars 是否可用，在定义类时选择对应的实现，避免每次访问属性时再做判断
+    if ContextVar is not None:
+        # __storage__ 为 ContextVar， 值为当前上下文的数据字典
+        def __init__(self):
+            object.__setattr__(self, '__storage__',
+                               ContextVar('werkzeug.local.%x' % id(self)))
+
+        def __iter__(self):
+            return iter(self.__storage__.get({}).items())
+
+        def __release_local__(self):
+            self.__storage__.set({})
+
+        def __getattr__(self, name):
+            try:
+                return self.__storage__.get()[name]    # 上下文中没有数据时 get() 会抛出 LookupError
+            except LookupError:
+                raise AttributeError(name)
+
+        def __setattr__(self, name, value):
+            storage = self.__storage__
+            values = dict(storage.get({}))    # 复制一份再修改，不影响继承了这个上下文的其他 task
+            values[name] = value
+            storage.set(values)
+
+        def __delattr__(self, name):
+            storage = self.__storage__
+            values = dict(storage.get({}))
+            try:
+                del values[name]
+            except KeyError:
+                raise AttributeError(name)
+            storage.set(values)
+    else:
+        # __storage__ 和 Local 一样是以线程或协程的 id 为 key 的嵌套字典
+        def __init__(self):
+            object.__setattr__(self, '__storage__', {})
+
+        def __iter__(self):
+            return self.__storage__.iteritems()
+
+        def __release_local__(self):
+            self.__storage__.pop(get_ident(), None)
+
+        def __getattr__(self, name):
+            try:
+                return self.__storage__[get_ident()][name]
+            except KeyError:
+                raise AttributeError(name)
+
+        def __setattr__(self, name, value):
+            self.__storage__.setdefault(get_ident(), {})[name] = value    # setdefault 是原子操作，不需要加锁
+
+        def __delattr__(self, name):
+            try:
+                del self.__storage__[get_ident()][name]
+            except KeyError:
+                raise AttributeError(name)
+
+
+# the lock based implementation stays available as `LockedLocal`, `Local`
+# refers to the implementation selected by `LOCAL_BACKEND`.
+LockedLocal = Local
+if LOCAL_BACKEND == 'context':
+    Local = ContextLocal
+
+
 class LocalStack(object):    # LocalStack 对象
     """This class works similar to a :class:`Local` but keeps a stack
     of objects instead.  This is best explained with an example::
@@ -163,7 +268,13 @@ class LocalStack(object):    # LocalStack 对象
 
     def __init__(self):
         self._local = Local()    # _local 属性是实例化的 Local 对象
-        self._lock = allocate_lock()
+        if isinstance(self._local, ContextLocal):    # 无锁的 Local 不需要 stack 的锁
+            self._lock = None
+            self._caches = None    # CachedLocalProxy 的缓存保存在 self._local.cache 中
+        else:
+            self._lock = allocate_lock()
+            # CachedLocalProxy 的缓存： {"线程或协程的 id": {"属性名": 对象}}，命中缓存时不需要获取 Local 的锁
+            self._caches = {}
 
     # LocalStack 中所有的数据操作都是基于 self.local 即实例化的 Local 对象完成的
     # self._local 的 __storage__ 结构： {"线程 1 或协程 1 的 id":{"stack": [obj1, obj2], "key1":"value1", "key2":"value2"}, "线程 2 或协程 2 的 id":{"stack": [obj1, obj2],"key1":"value1", "key2":"value2"}......}
@@ -207,6 +318,8 @@ class LocalStack(object):    # LocalStack 对象
 
     def __release_local__(self):
         self._local.__release_local__()
+        if self._caches is not None:
+            self._caches.pop(get_ident(), None)
 
     def __call__(self):  # 重载 __call__ 方法
         def _lookup():  # 定义一个 _lookup 方法， 通过 self.top 方法判断 stack 中是否有对象
@@ -218,12 +331,19 @@ class LocalStack(object):    # LocalStack 对象
 
     def push(self, obj):    # push 操作， 即入栈操作
         """Pushes a new item to the stack"""
+        if self._lock is None:    # 无锁模式下，stack 只会被当前上下文访问，复制后再修改
+            rv = list(getattr(self._local, 'stack', ()))
+            rv.append(obj)
+            self._local.stack = rv
+            self._local.cache = {}
+            return rv
         self._lock.acquire()    # 先获取锁
         try:
             rv = getattr(self._local, 'stack', None)    # 获取 self._local 即实例化的 Local 对象的 stack 属性
             if rv is None:  # 如果属性不存在
                 self._local.stack = rv = []   # 初始化 self._local 即实例化的 Local 对象的 stack 为 []
             rv.append(obj)    # 并将 obj append 到列表中
+            self._caches[get_ident()] = {}    # 栈顶发生变化，清空 CachedLocalProxy 的缓存
             return rv
         finally:
             self._lock.release() # 释放锁
@@ -232,6 +352,16 @@ class LocalStack(object):    # LocalStack 对象
         """Removes the topmost item from the stack, will return the
         old value or `None` if the stack was already empty.
         """
+        if self._lock is None:
+            stack = getattr(self._local, 'stack', None)
+            if stack is None:
+                return None
+            elif len(stack) == 1:
+                release_local(self._local)
+            else:
+                self._local.stack = stack[:-1]
+                self._local.cache = {}
+            return stack[-1]
         self._lock.acquire() # 先获取锁
         try:
             stack = getattr(self._local, 'stack', None)    # 获取 self._local 即实例化的 Local 对象的 stack 属性
@@ -239,9 +369,12 @@ class LocalStack(object):    # LocalStack 对象
                 return None
             elif len(stack) == 1:    # 如果 stack 内的元素为一个
                 release_local(self._local)     # 执行 release_local 操作
+                self._caches.pop(get_ident(), None)
                 return stack[-1]     # 并返回 stack 中的元素
             else:
-                return stack.pop()    # pop stack 中最后一个
+                rv = stack.pop()    # pop stack 中最后一个
+                self._caches[get_ident()] = {}    # 栈顶发生变化，清空 CachedLocalProxy 的缓存
+                return rv
         finally:
             self._lock.release()    # 释放锁
 
@@ -270,7 +403,7 @@ class LocalManager(object):    # LocalManager 对象
     def __init__(self, locals=None):
         if locals is None:    # 如果 locals 为空
             self.locals = []    # 则 self.locals = []
-        elif isinstance(locals, Local):    # 如果 locals 为 Local 类的实例
+        elif isinstance(locals, (LockedLocal, ContextLocal)):    # 如果 locals 为 Local 类的实例
             self.locals = [locals]    # 则 self.locals = [locals]
         else:
             self.locals = list(locals)  # self.locals = [locals]
@@ -490,3 +623,40 @@ class LocalProxy(object):    # LocalProxy 类
     __coerce__ = lambda x, o: x.__coerce__(x, o)
     __enter__ = lambda x: x.__enter__()
     __exit__ = lambda x, *a, **kw: x.__exit__(*a, **kw)
+
+
+class CachedLocalProxy(LocalProxy):    # 带缓存的 LocalProxy
+    """A :class:`LocalProxy` for an attribute of the topmost item of a
+    :class:`LocalStack`::
+
+        _request_ctx_stack = LocalStack()
+        request = CachedLocalProxy(_request_ctx_stack, 'request')
+
+    The resolved object is remembered for the current context until the
+    next :meth:`~LocalStack.push` or :meth:`~LocalStack.pop` on the stack,
+    so repeated access only costs a dictionary lookup.  Because of that the
+    attribute must not be rebound on the item while it is on the stack.
+    """
+    __slots__ = ('__stack',)
+
+    def __init__(self, stack, name):
+        LocalProxy.__init__(self, stack, name)
+        object.__setattr__(self, '_CachedLocalProxy__stack', stack)
+
+    def _get_current_object(self):
+        stack = self.__stack
+        name = self.__name__
+        try:
+            caches = stack._caches    # push 时创建的缓存字典
+            if caches is None:
+                cache = stack._local.cache
+            else:
+                cache = caches[get_ident()]    # 普通的 dict，不需要获取 Local 的锁
+        except (AttributeError, KeyError):
+            raise RuntimeError('no object bound to %s' % name)
+        try:
+            return cache[name]
+        except KeyError:
+            rv = getattr(stack.top, name)    # 未命中时从栈顶对象获取，并存入缓存
+            cache[name] = rv
+            return rv
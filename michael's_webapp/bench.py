@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks for the db and orm modules that do not need a database.
+
+Run with: python bench.py
+'''
+
+import sys, time, threading, uuid, logging
+
+import db, orm
+
+def _result_set(rows, columns):    # 模拟一个结果集：列名和每一行的 values
+    names = ['column_%d' % i for i in range(columns)]
+    values = [tuple(u'value %d' % (r * columns + c) for c in range(columns)) for r in xrange(rows)]
+    return names, values
+
+def bench_rows(rows=100000, columns=10):
+    '''
+    Compare memory and build time of Dict rows and CompactRow rows for one result set.
+    Only the row containers are counted, the column values are shared by both.
+    '''
+    names, values = _result_set(rows, columns)
+    print 'rows (%d rows x %d columns):' % (rows, columns)
+
+    start = time.time()
+    L = [db.Dict(names, x) for x in values]
+    elapsed = time.time() - start
+    size = sum(sys.getsizeof(r) for r in L)
+    print '  %-10s %8.1f MB  %8.3f s' % ('Dict', size / 1048576.0, elapsed)
+    del L
+
+    start = time.time()
+    index = db._column_index(names)
+    L = [db.CompactRow(index, x) for x in values]
+    elapsed = time.time() - start
+    size = sys.getsizeof(index) + sum(sys.getsizeof(r) + sys.getsizeof(r._values) for r in L)
+    print '  %-10s %8.1f MB  %8.3f s' % ('CompactRow', size / 1048576.0, elapsed)
+
+def _legacy_next_id(t=None):    # 原来的 next_id：毫秒时间戳加 uuid4，共 50 个字符
+    if t is None:
+        t = time.time()
+    return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
+
+def bench_ids(number=200000, threads=4):
+    '''
+    Compare ids/sec of the old uuid4 based next_id with the IdGenerator based next_id and
+    next_ids, single threaded and from several threads at once.
+    '''
+    print 'ids (%d per run):' % number
+    funcs = [
+        ('uuid4', lambda: [_legacy_next_id() for _ in xrange(number)]),
+        ('next_id', lambda: [db.next_id() for _ in xrange(number)]),
+        ('next_ids', lambda: db.next_ids(number)),
+    ]
+    for name, func in funcs:
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        workers = [threading.Thread(target=func) for _ in xrange(threads)]
+        start = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        threaded = time.time() - start
+        print '  %-10s %12.0f ids/s  %12.0f ids/s with %d threads' % (
+            name, number / elapsed, number * threads / threaded, threads)
+
+class _StubCursor(object):    # 不访问数据库的 cursor，select 语句总是返回同一行
+    def __init__(self, names, row):
+        self._names = names
+        self._row = row
+        self.description = None
+        self.rowcount = 0
+
+    def execute(self, sql, args=()):
+        if sql.startswith('select'):
+            self.description = [(name,) for name in self._names]
+        else:
+            self.description = None
+        self.rowcount = 1
+
+    def fetchone(self):
+        return self._row
+
+    def fetchall(self):
+        return [self._row]
+
+    def close(self):
+        pass
+
+class _StubConnection(object):
+    def __init__(self, names, row):
+        self._names = names
+        self._row = row
+
+    def cursor(self):
+        return _StubCursor(self._names, self._row)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+def bench_crud(number=20000):
+    '''
+    Measure ops/sec of Model.insert(), get(), update() and delete() against a stub connection,
+    so only the orm and db layers are timed, not the database.
+    '''
+    class BenchUser(orm.Model):
+        id = orm.IntegerField(primary_key=True)
+        name = orm.StringField()
+        email = orm.StringField(updatable=False)
+        passwd = orm.StringField(default=lambda: '******')
+        created_at = orm.FloatField(default=time.time)
+        admin = orm.BooleanField()
+        score = orm.IntegerField()
+        bio = orm.TextField()
+
+    names = ['id', 'name', 'email', 'passwd', 'created_at', 'admin', 'score', 'bio']
+    row = (1, u'Michael', u'bench@example.org', u'******', time.time(), False, 0, u'')
+    saved = db.engine
+    db.engine = db._Engine(lambda: _StubConnection(names, row))
+    try:
+        user = BenchUser(id=1, name='Michael', email='bench@example.org')
+        print 'crud (%d calls each):' % number
+        with db.connection():    # 所有调用共用一个连接，只统计 orm 和 db 层的开销
+            for name, func in (('insert', lambda: BenchUser(id=1, name='Michael').insert()),
+                               ('get', lambda: BenchUser.get(1)),
+                               ('update', user.update),
+                               ('delete', user.delete)):
+                start = time.time()
+                for _ in xrange(number):
+                    func()
+                elapsed = time.time() - start
+                print '  %-8s %10.0f ops/s' % (name, number / elapsed)
+    finally:
+        db.engine = saved
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)    # 每条语句的 profiling 日志会掩盖 orm 本身的开销
+    bench_rows()
+    bench_ids()
+    bench_crud()
@@ -7,7 +7,25 @@ __author__ = 'Michael Liao'
 Database operation module.
 '''
 
-import time, uuid, functools, threading, logging
+import os, socket, time, functools, threading, logging, re, traceback
+
+from collections import OrderedDict, deque
+
+try:
+    from thread import get_ident as _get_thread_ident
+except ImportError:
+    from threading import get_ident as _get_thread_ident
+
+try:
+    from greenlet import getcurrent as _get_current_greenlet
+except ImportError:
+    _get_current_greenlet = None
+
+try:
+    import asyncio
+    _current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+except ImportError:
+    _current_task = None
 
 # Dict object:
 
@@ -62,27 +80,361 @@ class Dict(dict):    # 定义一个 Dict 类，继承自 dict
     def __setattr__(self, key, value):    # 重载 __setattr__ 方法，使得 Dict 支持 object.key = value 方式赋值
         self[key] = value
 
-def next_id(t=None): # 产生一个长度为 50 的字符串，用作 id
+class CompactRow(object):    # 紧凑的行对象，同一个结果集的所有行共用一个列名索引
+    '''
+    Read-only row that stores its values in a tuple and shares the column index map
+    with all rows of the same result set. Supports access as x.y and x['y'] style.
+
+    >>> index = _column_index(('a', 'b'))
+    >>> r = CompactRow(index, (1, 2))
+    >>> r.a
+    1
+    >>> r['b']
+    2
+    >>> r.keys()
+    ['a', 'b']
+    >>> dict(r) == {'a': 1, 'b': 2}
+    True
+    >>> r.c
+    Traceback (most recent call last):
+        ...
+    AttributeError: 'CompactRow' object has no attribute 'c'
+    '''
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        object.__setattr__(self, '_index', index)
+        object.__setattr__(self, '_values', values)
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __getattr__(self, key):
+        try:
+            return self._values[self._index[key]]
+        except KeyError:
+            raise AttributeError(r"'CompactRow' object has no attribute '%s'" % key)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('CompactRow is read-only')
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __eq__(self, other):
+        return dict(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'CompactRow(%r)' % dict(self)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
+
+    def keys(self):
+        return sorted(self._index, key=self._index.get)    # 按列的顺序返回列名
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self.keys(), self._values)
+
+def _column_index(names):    # 生成列名到列序号的映射，由同一个结果集的所有 CompactRow 共用
+    return dict((name, i) for i, name in enumerate(names))
+
+_ID_EPOCH = 1420070400000    # 2015-01-01 00:00:00 UTC，单位毫秒，41 位毫秒数可以使用到 2084 年
+_WORKER_BITS = 10
+_SEQUENCE_BITS = 12
+_MAX_SEQUENCE = (1 << _SEQUENCE_BITS) - 1
+_ID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'    # Crockford base32，字符按 ASCII 顺序排列，定长的字符串可以直接排序
+
+def _encode_id(i):    # 将 64 位整数编码为 13 个字符的定长字符串，字符串顺序与整数顺序一致
+    chars = []
+    for _ in xrange(13):
+        chars.append(_ID_ALPHABET[i & 31])
+        i >>= 5
+    return ''.join(reversed(chars))
+
+def _check_worker_id(worker_id):
+    if not 0 <= worker_id < (1 << _WORKER_BITS):
+        raise ValueError('worker_id must be between 0 and %d' % ((1 << _WORKER_BITS) - 1))
+    return worker_id
+
+def _default_worker_id():    # 优先使用环境变量 DB_WORKER_ID，否则由主机名和进程 id 计算
+    worker_id = os.environ.get('DB_WORKER_ID')
+    if worker_id is not None:
+        return _check_worker_id(int(worker_id))
+    # 只是尽量避免冲突：进程 id 对 1024 取模相同的进程会得到相同的 worker id
+    return (hash(socket.gethostname()) * 31 + os.getpid()) % (1 << _WORKER_BITS)
+
+class IdGenerator(object):
+    '''
+    Time ordered 64-bit ids: 41 bits of milliseconds since 2015-01-01, 10 bits of worker id and
+    12 bits of sequence number, so one worker can generate 4096 ids per millisecond. Ids of one
+    generator are strictly increasing, even if the clock goes backwards.
+
+    Every process must use a different worker id (0-1023) for ids to be unique across processes.
+    If worker_id is None it is read from the DB_WORKER_ID environment variable or else derived
+    from the host name and process id, and derived again in a forked child process. A derived
+    worker id is not guaranteed to be unique: processes whose ids are equal modulo 1024, on one
+    host or on different hosts, get the same worker id and can generate duplicate ids. Set a
+    distinct worker id per process where uniqueness matters.
+
+    A worker id given as argument or by DB_WORKER_ID is inherited by forked child processes,
+    where it would duplicate the ids of the parent. Generating an id in a child therefore raises
+    DBError until set_worker_id() is called or DB_WORKER_ID is changed in the child.
+
+    >>> g = IdGenerator(worker_id=5)
+    >>> a, b = g.next_int(), g.next_int()
+    >>> a < b and (a >> 12) & 1023 == 5
+    True
+    >>> ids = g.next_ints(5000)
+    >>> len(set(ids)) == 5000 and ids == sorted(ids) and ids[0] > b
+    True
+    >>> IdGenerator.to_str(a) < IdGenerator.to_str(b), len(IdGenerator.to_str(a))
+    (True, 13)
+    '''
+    def __init__(self, worker_id=None):
+        if worker_id is not None:
+            _check_worker_id(worker_id)
+        self._fixed_worker_id = worker_id
+        self._lock = threading.Lock()
+        self._pid = None
+        self.worker_id = None
+        self._reset()
+
+    def _reset(self):
+        worker_id = self._fixed_worker_id
+        configured = worker_id is not None or 'DB_WORKER_ID' in os.environ
+        if worker_id is None:
+            worker_id = _default_worker_id()
+        if self._pid is not None and configured and worker_id == self.worker_id:
+            # fork 之后子进程继承了父进程设置的 worker id，继续使用会产生和父进程相同的 id
+            raise DBError('Worker id %d of process %d is inherited by forked process %d, call '
+                          'set_worker_id() or change DB_WORKER_ID in the child.'
+                          % (worker_id, self._pid, os.getpid()))
+        self._pid = os.getpid()
+        self.worker_id = worker_id
+        self._last = -1    # 上一个 id 的 (毫秒数 << 12 | 序号)
+
+    def set_worker_id(self, worker_id):
+        '''
+        Use worker_id from now on, typically in a forked child process.
+        '''
+        _check_worker_id(worker_id)
+        with self._lock:
+            self._fixed_worker_id = worker_id
+            self._pid = os.getpid()
+            self.worker_id = worker_id
+
+    def _allocate(self, n, t):    # 分配 n 个连续的 (毫秒数 << 12 | 序号)，返回第一个，调用方需持有锁
+        if self._pid != os.getpid():
+            self._reset()    # fork 之后子进程需要新的 worker id
+        ms = int((time.time() if t is None else t) * 1000) - _ID_EPOCH
+        first = max(ms << _SEQUENCE_BITS, self._last + 1)    # 时钟回拨或同一毫秒内序号用完时借用后面的毫秒，保证单调递增
+        self._last = first + n - 1
+        return first
+
+    def _compose(self, value):    # 在毫秒数和序号之间插入 worker id
+        return ((value >> _SEQUENCE_BITS) << (_WORKER_BITS + _SEQUENCE_BITS)) | \
+            (self.worker_id << _SEQUENCE_BITS) | (value & _MAX_SEQUENCE)
+
+    def next_int(self, t=None):
+        '''
+        Return the next id as integer. t is a unix timestamp to use instead of time.time(); ids
+        never go backwards, so a t before the time of the last id has no effect.
+        '''
+        with self._lock:
+            return self._compose(self._allocate(1, t))
+
+    def next_ints(self, n):
+        '''
+        Return a list of the next n ids, allocated at once.
+        '''
+        with self._lock:
+            first = self._allocate(n, None)
+            compose = self._compose
+            return [compose(value) for value in xrange(first, first + n)]
+
+    @staticmethod
+    def to_str(i):
+        '''
+        Return the 13-char string form of an id. Strings sort in the same order as the ids.
+        '''
+        return _encode_id(i)
+
+    @staticmethod
+    def timestamp(i):
+        '''
+        Return the unix timestamp encoded in an id.
+        '''
+        return ((i >> (_WORKER_BITS + _SEQUENCE_BITS)) + _ID_EPOCH) / 1000.0
+
+# global id generator used by next_id() and next_ids():
+id_generator = IdGenerator()
+
+def next_id(t=None): # 产生一个长度为 13 的按时间排序的字符串，用作 id
     '''
-    Return next id as 50-char string.
+    Return next id as 13-char string, see IdGenerator.
 
     Args:
         t: unix timestamp, default to None and using time.time().
+
+    >>> a = next_id()
+    >>> b = next_id()
+    >>> len(a), a < b
+    (13, True)
+    '''
+    return _encode_id(id_generator.next_int(t))
+
+def next_ids(n):
+    '''
+    Return a list of the next n ids as 13-char strings, allocated at once.
+
+    >>> ids = next_ids(3)
+    >>> len(set(ids)), ids == sorted(ids)
+    (3, True)
+    '''
+    return [_encode_id(i) for i in id_generator.next_ints(n)]
+
+_literals_re = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b")
+_values_re = re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\1)+')
+
+def _normalize_sql(sql):    # 合并空白、把常量替换为 ?、把多行 values 合并为一组，使只有参数不同的语句归为一类
+    sql = _literals_re.sub('?', ' '.join(sql.split()))
+    return _values_re.sub(r'\1, ...', sql)
+
+class _Profiler(object):    # 按规范化后的 sql 聚合执行次数、总耗时、最大耗时和耗时分布
+    '''
+    Aggregated statement timings, see profiling_stats().
+    '''
+    # upper bounds of the histogram buckets in seconds, the last bucket has no upper bound:
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, slow_threshold=0.1, capture_stack=True, max_slow=100):
+        self.slow_threshold = slow_threshold
+        self.capture_stack = capture_stack
+        self._lock = threading.Lock()
+        self._stats = {}    # 规范化的 sql -> [count, total, max, histogram]
+        self._normalized = {}    # 原始 sql -> 规范化的 sql
+        self._slow = deque(maxlen=max_slow)    # 最近的慢查询
+
+    def record(self, sql, t):
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            if len(self._normalized) > 10000:
+                self._normalized.clear()
+            normalized = self._normalized[sql] = _normalize_sql(sql)
+        i = 0
+        while i < len(self.buckets) and t > self.buckets[i]:
+            i += 1
+        slow = self.slow_threshold is not None and t >= self.slow_threshold
+        if slow:
+            stack = self.capture_stack and ''.join(traceback.format_stack()[:-3]) or None    # 去掉 profiler 自身的栈帧
+        with self._lock:
+            stat = self._stats.get(normalized)
+            if stat is None:
+                stat = self._stats[normalized] = [0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+            stat[0] += 1
+            stat[1] += t
+            stat[2] = max(stat[2], t)
+            stat[3][i] += 1
+            if slow:
+                self._slow.append(dict(sql=sql, time=t, at=time.time(), stack=stack))
+        return slow
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            stats, slow = self._stats, list(self._slow)
+            if reset:
+                self._stats = {}
+                self._slow.clear()
+            else:
+                stats = dict((k, v[:3] + [list(v[3])]) for k, v in stats.iteritems())
+        bounds = list(self.buckets) + [None]
+        return dict(
+            statements=dict((sql, dict(count=count, total=total, max=max_time, avg=total / count,
+                                       histogram=zip(bounds, histogram)))
+                            for sql, (count, total, max_time, histogram) in stats.iteritems()),
+            slow=slow)
+
+_profiler = _Profiler()
+
+def set_profiling(slow_threshold=0.1, capture_stack=True):
+    '''
+    Configure the statement profiler. Statements taking at least slow_threshold seconds (None to
+    disable) are logged as warnings and kept with their call stack (if capture_stack) in the
+    'slow' list of profiling_stats().
+    '''
+    _profiler.slow_threshold = slow_threshold
+    _profiler.capture_stack = capture_stack
+
+def profiling_stats(reset=False):
+    '''
+    Return a snapshot of the statement timings as a dict, suitable for an admin endpoint:
+
+        {'statements': {normalized_sql: {'count', 'total', 'avg', 'max', 'histogram'}},
+         'slow': [{'sql', 'time', 'at', 'stack'}, ...]}
+
+    histogram is a list of (upper bound in seconds, count) pairs, the last bound is None.
+    Times are in seconds. Pass reset=True to clear the statistics at the same time.
+
+    >>> reset_profiling_stats()
+    >>> n = select_int('select count(*) from user where id=?', 1)
+    >>> n = select_int('select  count(*) from user where id=?', 2)
+    >>> stats = profiling_stats()['statements']
+    >>> stats['select count(*) from user where id=?']['count']
+    2
+    '''
+    return _profiler.snapshot(reset)
+
+def reset_profiling_stats():
+    '''
+    Clear the statement timings and the slow statement list.
     '''
-    if t is None:
-        t = time.time()
-    return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
+    _profiler.snapshot(reset=True)
 
-def _profiling(start, sql=''):    # 如果某条 sql 语句执行时间超过 0.1 秒则记录日志
+def _profiling(start, sql=''):    # 记录 sql 语句的执行时间，超过慢查询阈值时记录警告日志
     t = time.time() - start
-    if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
+    if _profiler.record(sql, t):
+        logging.warning('[PROFILING] [DB] %s: %s', t, sql)
     else:
-        logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
+        logging.info('[PROFILING] [DB] %s: %s', t, sql)
 
 class DBError(Exception):
     pass
 
+# max number of statements kept by the statement caches:
+_STATEMENT_CACHE_SIZE = 256
+
+_statements = OrderedDict()    # 缓存 ? 风格的 sql 语句到 %s 风格的 sql 语句的转换结果
+_statements_lock = threading.Lock()
+
+def _convert_sql(sql):
+    '''
+    Return sql with '?' placeholders replaced by '%s'. Results are cached.
+    '''
+    try:
+        return _statements[sql]    # 命中缓存时无需加锁
+    except KeyError:
+        pass
+    converted = sql.replace('?', '%s')
+    with _statements_lock:
+        _statements[sql] = converted
+        if len(_statements) > _STATEMENT_CACHE_SIZE:
+            _statements.popitem(last=False)    # 删除最早加入的语句
+    return converted
+
 class MultiColumnsError(DBError):
     pass
 
@@ -91,18 +443,32 @@ class _LasyConnection(object):
     def __init__(self):
         self.connection = None
 
-    def cursor(self):
+    def _connect(self):
         if self.connection is None:
             connection = engine.connect()    # 调用全局变量 engine 的 connect 方法
             logging.info('open connection <%s>...' % hex(id(connection)))
             self.connection = connection   # 将 connection 赋值给 self.connection
-        return self.connection.cursor()
+        return self.connection
+
+    def cursor(self):
+        return self._connect().cursor()
+
+    def prepared_cursor(self, sql):
+        '''
+        Return the cached prepared cursor for sql, or None if the connection does not prepare statements.
+        '''
+        connection = self._connect()
+        if getattr(connection, 'prepared', False):
+            return connection.prepared_cursor(sql)
+        return None
 
     def commit(self):
-        self.connection.commit()
+        if self.connection is not None:    # 没有执行过语句时连接还未打开，无需提交
+            self.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection is not None:
+            self.connection.rollback()
 
     def cleanup(self):
         if self.connection:
@@ -111,25 +477,101 @@ class _LasyConnection(object):
             logging.info('close connection <%s>...' % hex(id(connection)))
             connection.close()
 
-class _DbCtx(threading.local):    # 定义一个 _DbCtx 类，继承自 threading.local
+def _thread_ident():
+    return _get_thread_ident()
+
+def _greenlet_ident():    # 与 werkzeug 的 get_ident 相同：线程 id 加当前 greenlet
+    return (_get_thread_ident(), _get_current_greenlet())
+
+def _task_ident():    # 在 asyncio task 中运行时返回当前 task，否则返回线程 id
+    try:
+        task = _current_task()
+    except RuntimeError:    # 当前线程没有运行中的事件循环
+        task = None
+    return _get_thread_ident() if task is None else task
+
+_CONTEXT_IDENTS = {'thread': _thread_ident, 'greenlet': _greenlet_ident, 'asyncio': _task_ident}
+
+# 默认与 werkzeug 的 Local 一致：安装了 greenlet 时按 greenlet 隔离，否则按线程隔离
+_ctx_ident = _get_current_greenlet is None and _get_thread_ident or _greenlet_ident
+
+def set_context_ident(ident):
+    '''
+    Set how the db context (connection and transaction state) is isolated between concurrent requests.
+    ident is 'thread', 'greenlet', 'asyncio' or a function returning a hashable id of the current context,
+    for example werkzeug.local.get_ident.
+
+    >>> set_context_ident('thread')
+    >>> set_context_ident('fiber')
+    Traceback (most recent call last):
+      ...
+    ValueError: unknown context ident 'fiber'
+    '''
+    global _ctx_ident
+    if not callable(ident):
+        if ident not in _CONTEXT_IDENTS:
+            raise ValueError('unknown context ident %r' % ident)
+        if ident == 'greenlet' and _get_current_greenlet is None:
+            raise ValueError('greenlet is not installed')
+        if ident == 'asyncio' and _current_task is None:
+            raise ValueError('asyncio is not available')
+        ident = _CONTEXT_IDENTS[ident]
+    _ctx_ident = ident
+
+class _DbCtx(object):    # 定义一个 _DbCtx 类，按 _ctx_ident 返回的上下文 id 隔离数据
     '''
-    Thread local object that holds connection info.
+    Context local object that holds connection info, isolated per thread, greenlet or asyncio task (see set_context_ident).
     '''
     def __init__(self):
-        self.connection = None
-        self.transactions = 0
+        self._storage = {}    # 上下文 id -> [connection, transactions, 事务结束时的回调]，dict 的单个操作在 GIL 下是原子的，无需加锁
+
+    def _state(self):
+        ident = _ctx_ident()
+        state = self._storage.get(ident)
+        if state is None:
+            state = self._storage[ident] = [None, 0, []]
+        return state
+
+    @property
+    def connection(self):
+        state = self._storage.get(_ctx_ident())
+        return None if state is None else state[0]
+
+    @connection.setter
+    def connection(self, connection):
+        self._state()[0] = connection
+
+    @property
+    def transactions(self):
+        state = self._storage.get(_ctx_ident())
+        return 0 if state is None else state[1]
+
+    @transactions.setter
+    def transactions(self, transactions):
+        self._state()[1] = transactions
+
+    def after_transaction(self, func):
+        self._state()[2].append(func)
+
+    def end_transaction(self):    # 最外层事务结束，依次调用注册的回调
+        state = self._storage.get(_ctx_ident())
+        if state is None:
+            return
+        callbacks, state[2] = state[2], []
+        for func in callbacks:
+            func()
 
     def is_init(self):
         return not self.connection is None
 
     def init(self):
         logging.info('open lazy connection...')
-        self.connection = _LasyConnection()    # 实例化 _LazyConnection()
-        self.transactions = 0
+        self._storage[_ctx_ident()] = [_LasyConnection(), 0, []]    # 实例化 _LazyConnection()
 
     def cleanup(self):
-        self.connection.cleanup()
-        self.connection = None
+        state = self._storage.pop(_ctx_ident(), None)    # 释放当前上下文的数据，避免 greenlet 或 task 结束后残留
+        if state is not None and state[0] is not None:
+            state[0].cleanup()
 
     def cursor(self):
         '''
@@ -137,25 +579,226 @@ class _DbCtx(threading.local):    # 定义一个 _DbCtx 类，继承自 threadin
         '''
         return self.connection.cursor()
 
-# thread-local db context:
+# context-local db context:
 _db_ctx = _DbCtx()    # 实例化 _DbCtx 类
 
 # global engine object:
 engine = None    # 定义一个全局变量 engine
 
+class _PooledConnection(object):    # 连接池中的连接，close 时归还给连接池而不是关闭
+    '''
+    Connection checked out from a _ConnectionPool. Calling close() returns it to the pool.
+    '''
+    def __init__(self, pool, connection, prepared=False):
+        self.pool = pool
+        self.connection = connection
+        self.prepared = prepared
+        self.statements = OrderedDict()    # 此连接上的服务端 prepared statement: sql -> cursor
+        self.created_at = self.last_used = time.time()
+
+    def cursor(self, *args, **kw):
+        return self.connection.cursor(*args, **kw)
+
+    def prepared_cursor(self, sql):
+        '''
+        Return a prepared cursor for the '?' style sql, reusing the one prepared before on this connection.
+        The cursor is not buffered, the caller has to fetch the whole result before the next statement.
+        '''
+        cursor = self.statements.pop(sql, None)
+        if cursor is None:
+            # create_engine() 打开的连接默认使用 buffered cursor，而 prepared cursor 不支持 buffered，
+            # 需要显式关闭，由调用方读取全部结果
+            cursor = self.connection.cursor(prepared=True, buffered=False)
+            if len(self.statements) >= _STATEMENT_CACHE_SIZE:
+                self.statements.popitem(last=False)[1].close()    # 关闭最久未使用的 prepared statement
+        self.statements[sql] = cursor    # 移动到末尾
+        return cursor
+
+    def close_statements(self):
+        for cursor in self.statements.itervalues():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        self.statements.clear()
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.pool.checkin(self)
+
+class _ConnectionPool(object):    # 线程安全的连接池
+    '''
+    Thread-safe pool of database connections.
+
+    Args:
+        connect: function that opens a new connection.
+        min_size: number of idle connections that are kept open regardless of max_idle.
+        max_size: max number of connections opened at the same time.
+        max_idle: idle connections above min_size are closed after max_idle seconds.
+        max_lifetime: connections are closed max_lifetime seconds after they were opened.
+        timeout: seconds to wait for a free connection before raising DBError, None waits forever.
+        prepared: keep a server-side prepared statement per connection and sql.
+    '''
+    def __init__(self, connect, min_size=0, max_size=10, max_idle=300, max_lifetime=3600, timeout=10,
+                 prepared=False):
+        if max_size < 1 or min_size > max_size:
+            raise DBError('Invalid pool size: min=%s, max=%s' % (min_size, max_size))
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.prepared = prepared
+        self._cond = threading.Condition()
+        self._idle = []    # 空闲的连接，后进先出
+        self._size = 0    # 已经打开的连接数
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._max_overflow = 0
+
+    def _expired(self, conn, now):    # 连接超过最大生存时间，或者空闲时间过长且连接数多于 min_size
+        if now - conn.created_at > self.max_lifetime:
+            return True
+        return now - conn.last_used > self.max_idle and self._size > self.min_size
+
+    def checkout(self):
+        '''
+        Return a pooled connection, opening a new one if no idle connection is available
+        and the pool is not full. Otherwise wait up to timeout seconds, or until a connection
+        is returned if timeout is None.
+        '''
+        start = time.time()
+        expired = []
+        waited = False
+        try:
+            with self._cond:
+                self._checkouts += 1
+                while True:
+                    now = time.time()
+                    while self._idle:
+                        conn = self._idle.pop()
+                        if self._expired(conn, now):
+                            self._size -= 1
+                            expired.append(conn)
+                            continue
+                        return conn
+                    if self._size < self.max_size:    # 连接池未满，新建连接
+                        self._size += 1
+                        self._max_overflow = max(self._max_overflow, self._size - self.min_size)
+                        break
+                    remaining = None    # timeout 为 None 时一直等待
+                    if self.timeout is not None:
+                        remaining = start + self.timeout - now
+                        if remaining <= 0:
+                            self._timeouts += 1
+                            raise DBError('Timeout after %s seconds waiting for a pooled connection.' % self.timeout)
+                    if not waited:
+                        waited = True
+                        self._waits += 1
+                    self._cond.wait(remaining)    # 等待其他线程归还连接
+        finally:
+            if waited:
+                with self._cond:
+                    self._wait_time += time.time() - start
+            for conn in expired:
+                self._close(conn)
+        try:
+            connection = self._connect()    # 在锁外面新建连接
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        logging.info('open pooled connection <%s>...' % hex(id(connection)))
+        return _PooledConnection(self, connection, self.prepared)
+
+    def checkin(self, conn):
+        '''
+        Reset the connection and return it to the pool.
+        '''
+        try:
+            if getattr(conn.connection, 'in_transaction', True):    # 回滚未提交的事务，重置连接的状态
+                conn.connection.rollback()
+        except Exception:
+            logging.warning('reset pooled connection <%s> failed.' % hex(id(conn.connection)))
+            discard = True
+        else:
+            discard = time.time() - conn.created_at > self.max_lifetime
+        with self._cond:
+            if discard:
+                self._size -= 1
+            else:
+                conn.last_used = time.time()
+                self._idle.append(conn)
+            self._cond.notify()
+        if discard:
+            self._close(conn)
+
+    def _close(self, conn):
+        logging.info('close pooled connection <%s>...' % hex(id(conn.connection)))
+        try:
+            conn.close_statements()
+            conn.connection.close()
+        except Exception:
+            logging.warning('close pooled connection <%s> failed.' % hex(id(conn.connection)))
+
+    def stats(self):
+        '''
+        Return pool statistics as dict.
+        '''
+        with self._cond:
+            return dict(
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                overflow=max(self._size - self.min_size, 0),
+                max_overflow=self._max_overflow,
+                checkouts=self._checkouts,
+                waits=self._waits,
+                wait_time=self._wait_time,
+                timeouts=self._timeouts)
+
 class _Engine(object):    # 定义一个 _Engine 类
 
-    def __init__(self, connect):
+    def __init__(self, connect, pool=None):
         self._connect = connect
+        self.pool = pool
 
     def connect(self):
+        if self.pool is not None:    # 使用连接池时，从连接池中获取连接
+            return self.pool.checkout()
         return self._connect()
 
+    def stats(self):
+        '''
+        Return statistics of the connection pool, or None if no pool is used.
+        '''
+        if self.pool is None:
+            return None
+        return self.pool.stats()
+
+_POOL_ARGS = dict(pool_min_size='min_size', pool_max_size='max_size', pool_max_idle='max_idle',
+                  pool_max_lifetime='max_lifetime', pool_timeout='timeout',
+                  pool_prepared_statements='prepared')
+
 def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
+    '''
+    Initialize the global engine. Connections are pooled if pool_max_size is given, the other
+    pool_* arguments are passed to _ConnectionPool, everything else to mysql.connector.connect().
+    '''
     import mysql.connector
     global engine    # 声明 engine 为全局变量
     if engine is not None:
         raise DBError('Engine is already initialized.')
+    pool_args = dict((_POOL_ARGS[k], kw.pop(k)) for k in _POOL_ARGS.keys() if k in kw)    # 从 kw 中取出连接池的参数
     params = dict(user=user, password=password, database=database, host=host, port=port)
     defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
     for k, v in defaults.iteritems():   # 使用 **kw 中的值来更新 param 中的值
@@ -163,7 +806,11 @@ def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
     params.update(kw)
     params['buffered'] = True
     # 实例化 _Engine 类，传入 lambda: mysql.connector.connect(**params)
-    engine = _Engine(lambda: mysql.connector.connect(**params))
+    connect = lambda: mysql.connector.connect(**params)
+    pool = None
+    if 'max_size' in pool_args:
+        pool = _ConnectionPool(connect, **pool_args)
+    engine = _Engine(connect, pool)
     # test connection...
     logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
 
@@ -239,10 +886,13 @@ class _TransactionCtx(object):
         _db_ctx.transactions -= 1    # _db_ctx.transactions 自减 1
         try:
             if _db_ctx.transactions == 0:    # 如果_db_ctx.transactions 为 0， 则证明此事务为最外层事务，需要提交或回滚
-                if exctype is None:
-                    self.commit()
-                else:
-                    self.rollback()
+                try:
+                    if exctype is None:
+                        self.commit()
+                    else:
+                        self.rollback()
+                finally:
+                    _db_ctx.end_transaction()    # 提交或回滚之后调用 after_transaction 注册的回调
         finally:
             if self.should_close_conn:
                 _db_ctx.cleanup()
@@ -292,6 +942,22 @@ def transaction():
     '''
     return _TransactionCtx()
 
+def in_transaction():
+    '''
+    Return True if a transaction is active in the current context.
+    '''
+    return _db_ctx.transactions > 0
+
+def after_transaction(func):
+    '''
+    Call func without arguments when the outermost transaction of the current context ends,
+    after the commit or the rollback. If no transaction is active func is called at once.
+    '''
+    if _db_ctx.transactions > 0:
+        _db_ctx.after_transaction(func)
+    else:
+        func()
+
 def with_transaction(func):
     '''
     A decorator that makes function around transaction.
@@ -316,38 +982,57 @@ def with_transaction(func):
     @functools.wraps(func)
     def _wrapper(*args, **kw):
         _start = time.time()
-        with _TransactionCtx():
-            return func(*args, **kw)
-        _profiling(_start)
+        try:
+            with _TransactionCtx():
+                return func(*args, **kw)
+        finally:
+            _profiling(_start, 'transaction %s' % func.__name__)    # 放在 finally 中，return 之后也会执行
     return _wrapper
 
-def _select(sql, first, *args):
+def _select(sql, first, *args, **kw):
     ' execute select SQL and return unique result or list results.'
     global _db_ctx
+    compact = kw.pop('compact', False)    # compact 为 True 时返回 CompactRow， 否则返回 Dict
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    logging.info('SQL: %s, ARGS: %s', sql, args)    # 由 logging 负责格式化，日志级别不够时不会格式化字符串
+    _start = time.time()
+    prepared = _db_ctx.connection.prepared_cursor(sql)    # 连接支持时使用缓存的 prepared statement
     try:
-        cursor = _db_ctx.connection.cursor()    # 获取 cursor
-        cursor.execute(sql, args)
+        if prepared is not None:
+            prepared.execute(sql, args)
+            cursor = prepared
+        else:
+            cursor = _db_ctx.connection.cursor()    # 获取 cursor
+            cursor.execute(_convert_sql(sql), args)
         if cursor.description:    # 获取对应表的列名
             names = [x[0] for x in cursor.description]
         if first:    # 如果参数 first 不为 None
             values = cursor.fetchone()
+            if prepared is not None:
+                cursor.fetchall()    # prepared cursor 会被复用，需要读取剩余的结果
             if not values:
                 return None
+            if compact:
+                return CompactRow(_column_index(names), tuple(values))
             return Dict(names, values)    # 实例化 Dict 类，传入 names（列名）和 values（第一行），并返回
+        if compact:
+            index = _column_index(names)    # 所有行共用一个列名索引
+            return [CompactRow(index, tuple(x)) for x in cursor.fetchall()]
         return [Dict(names, x) for x in cursor.fetchall()]   # 实例化 Dict 类，传入 names（列名）和 values（所有行），并返回
     finally:
-        if cursor:
+        if cursor and prepared is None:
             cursor.close()    # 关闭 cursor
+        _profiling(_start, sql)
 
 @with_connection
-def select_one(sql, *args):
+def select_one(sql, *args, **kw):
     '''
     Execute select SQL and expected one result. 
     If no result found, return None.
     If multiple results found, the first one returned.
+    Pass compact=True to get a CompactRow instead of a Dict.
 
     >>> u1 = dict(id=100, name='Alice', email='alice@test.org', passwd='ABC-12345', last_modified=time.time())
     >>> u2 = dict(id=101, name='Sarah', email='sarah@test.org', passwd='ABC-12345', last_modified=time.time())
@@ -362,8 +1047,10 @@ def select_one(sql, *args):
     >>> u2 = select_one('select * from user where passwd=? order by email', 'ABC-12345')
     >>> u2.name
     u'Alice'
+    >>> select_one('select * from user where id=?', 100, compact=True).name
+    u'Alice'
     '''
-    return _select(sql, True, *args)
+    return _select(sql, True, *args, **kw)
 
 @with_connection
 def select_int(sql, *args):
@@ -396,9 +1083,10 @@ def select_int(sql, *args):
     return d.values()[0]
 
 @with_connection
-def select(sql, *args):
+def select(sql, *args, **kw):
     '''
     Execute select SQL and return list or empty list if no result.
+    Pass compact=True to get CompactRow objects sharing one column index instead of Dict objects.
 
     >>> u1 = dict(id=200, name='Wall.E', email='wall.e@test.org', passwd='back-to-earth', last_modified=time.time())
     >>> u2 = dict(id=201, name='Eva', email='eva@test.org', passwd='back-to-earth', last_modified=time.time())
@@ -417,18 +1105,72 @@ def select(sql, *args):
     u'Eva'
     >>> L[1].name
     u'Wall.E'
+    >>> L = select('select * from user where passwd=? order by id desc', 'back-to-earth', compact=True)
+    >>> L[1]['name']
+    u'Wall.E'
+    '''
+    return _select(sql, False, *args, **kw)
+
+def select_iter(sql, *args, **kw):
     '''
-    return _select(sql, False, *args)
+    Execute select SQL and yield results one by one. Rows are read from an unbuffered cursor in
+    batches of batch_size (default 1000) so memory use does not grow with the result set.
+
+    The query runs on its own connection which is held until the generator is exhausted or
+    closed, so other statements can be executed while iterating, but uncommitted changes of
+    the current transaction are not visible. Pass compact=True to get CompactRow objects.
+
+    >>> u1 = dict(id=300, name='Tom', email='tom@test.org', passwd='iter', last_modified=time.time())
+    >>> u2 = dict(id=301, name='Jerry', email='jerry@test.org', passwd='iter', last_modified=time.time())
+    >>> insert('user', **u1)
+    1
+    >>> insert('user', **u2)
+    1
+    >>> [u.name for u in select_iter('select * from user where passwd=? order by id', 'iter', batch_size=1)]
+    [u'Tom', u'Jerry']
+    '''
+    batch_size = kw.pop('batch_size', 1000)
+    compact = kw.pop('compact', False)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    connection = engine.connect()    # 独占一个连接，直到迭代结束或生成器被关闭
+    cursor = None
+    try:
+        cursor = connection.cursor(buffered=False)    # 使用非缓冲的 cursor， 结果留在服务端按批读取
+        _start = time.time()
+        cursor.execute(_convert_sql(sql), args)
+        _profiling(_start, sql)    # 只统计执行时间，读取结果的时间取决于调用方
+        names = [x[0] for x in cursor.description]
+        index = _column_index(names)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for values in rows:
+                yield CompactRow(index, tuple(values)) if compact else Dict(names, values)
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                logging.warning('close streaming cursor failed.')
+        connection.close()    # 提前关闭时连接上还有未读取的结果，连接池会在归还时丢弃这个连接
 
 @with_connection
 def _update(sql, *args):
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    _start = time.time()
+    prepared = _db_ctx.connection.prepared_cursor(sql)
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
+        if prepared is not None:
+            prepared.execute(sql, args)
+            cursor = prepared
+        else:
+            cursor = _db_ctx.connection.cursor()
+            cursor.execute(_convert_sql(sql), args)
         r = cursor.rowcount    # r 为 mysql 返回的影响行数
         if _db_ctx.transactions == 0:
             # no transaction enviroment:
@@ -436,8 +1178,9 @@ def _update(sql, *args):
             _db_ctx.connection.commit()   # 提交事务
         return r
     finally:
-        if cursor:
+        if cursor and prepared is None:
             cursor.close()
+        _profiling(_start, sql)
 
 def insert(table, **kw):
     '''
@@ -459,6 +1202,49 @@ def insert(table, **kw):
     sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
     return _update(sql, *args)
 
+def insert_many(table, rows, chunk_size=500):
+    '''
+    Execute multi-row insert SQL for rows (an iterable of dicts with the same keys), sending
+    chunk_size rows per statement inside one transaction. Return number of rows inserted.
+
+    >>> rows = [dict(id=3000 + i, name='Bulk%d' % i, email='bulk%d@test.org' % i, passwd='bulk', last_modified=time.time()) for i in range(5)]
+    >>> insert_many('user', rows, chunk_size=2)
+    5
+    >>> select_int('select count(*) from user where passwd=?', 'bulk')
+    5
+    >>> insert_many('user', [])
+    0
+    '''
+    total = 0
+    cols = None
+    chunk = []
+    with _TransactionCtx():    # 所有的 insert 语句在同一个事务中执行
+        for row in rows:
+            if cols is None:
+                cols = tuple(row.iterkeys())
+                # 格式化 sql 语句
+                prefix = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+                placeholder = '(%s)' % ','.join(['?' for col in cols])
+            elif len(row) != len(cols):
+                raise DBError('All rows must have the same columns.')
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                total += _insert_chunk(prefix, placeholder, cols, chunk)
+                chunk = []
+        if chunk:
+            total += _insert_chunk(prefix, placeholder, cols, chunk)
+    return total
+
+def _insert_chunk(prefix, placeholder, cols, chunk):
+    args = []
+    try:
+        for row in chunk:
+            args.extend([row[col] for col in cols])
+    except KeyError as e:
+        raise DBError('All rows must have the same columns, missing: %s' % e)
+    # 相同行数的语句是一样的，可以命中语句缓存
+    return _update(prefix + ','.join([placeholder] * len(chunk)), *args)
+
 def update(sql, *args):
     r'''
     Execute update SQL.
@@ -486,8 +1272,8 @@ def update(sql, *args):
 if __name__=='__main__':
     """
     create_engine 会根据传入参数修改全局变量 engine ， engine 为 _Engine(lambda: mysql.connector.connect(**params))
-    _db_ctx 为 _DbCtx 的实例，并且是全局变量，由于 _DbCtx 继承自 threading.local，故每个线程在访问 _db_ctx 时都是隔离的，不会
-    相互影响，在真正执行数据库操作时，执行顺序如下： _db_ctx.init() -> self.connection = _LasyConnection() ->
+    _db_ctx 为 _DbCtx 的实例，并且是全局变量，_DbCtx 按 _ctx_ident 返回的 id（线程、greenlet 或 asyncio task）保存数据，故每个
+    线程或协程在访问 _db_ctx 时都是隔离的，不会相互影响（通过 set_context_ident 切换），在真正执行数据库操作时，执行顺序如下： _db_ctx.init() -> self.connection = _LasyConnection() ->
     connection = engine.connect() -> 获取 cursor
 
     with_connection 可以多层嵌套，如果连接存在则使用，如果不存在则新建连接
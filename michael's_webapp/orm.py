@@ -7,7 +7,9 @@ __author__ = 'Michael Liao'
 Database operation module. This module is independent with web module.
 '''
 
-import time, logging
+import time, logging, functools, threading
+
+from collections import OrderedDict
 
 import db
 
@@ -102,6 +104,103 @@ class VersionField(Field):    # VersionField 类继承自 Field
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
 
+class _ModelCache(object):    # 进程级别的 LRU 缓存，按主键缓存 Model.get 查询到的行
+    '''
+    Process-wide LRU cache of rows by primary key, used by Model.get() of models that
+    define __cache__. Entries expire after ttl seconds.
+    '''
+
+    def __init__(self, max_entries=1000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._rows = OrderedDict()    # pk -> (过期时间, row)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.identity_hits = 0
+
+    def get(self, pk):
+        with self._lock:
+            item = self._rows.pop(pk, None)
+            if item is None or item[0] < time.time():    # 不存在或者已经过期
+                self.misses += 1
+                return None
+            self._rows[pk] = item    # 移动到 LRU 的末尾
+            self.hits += 1
+            return item[1]
+
+    def put(self, pk, row):
+        with self._lock:
+            self._rows.pop(pk, None)
+            self._rows[pk] = (time.time() + self.ttl, row)
+            if len(self._rows) > self.max_entries:
+                self._rows.popitem(last=False)    # 删除最久未使用的行
+
+    def invalidate(self, pk):
+        with self._lock:
+            self._rows.pop(pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._rows), hits=self.hits, misses=self.misses,
+                        identity_hits=self.identity_hits)
+
+
+class _IdentityMapCtx(threading.local):    # 保存当前线程的 identity map
+    '''
+    Thread local object that holds the identity map of the current scope.
+    '''
+    def __init__(self):
+        self.objects = None    # (model class, pk) -> model 实例，不在 scope 中时为 None
+        self.depth = 0
+
+_identity_ctx = _IdentityMapCtx()
+
+
+class _IdentityMapScope(object):
+    '''
+    Scope of an identity map. Scopes can be nested and only the most outer one has effect.
+    '''
+
+    def __enter__(self):
+        if _identity_ctx.depth == 0:
+            _identity_ctx.objects = {}
+        _identity_ctx.depth += 1
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        _identity_ctx.depth -= 1
+        if _identity_ctx.depth == 0:
+            _identity_ctx.objects = None
+
+
+def identity_map():
+    '''
+    Return an identity map scope that can be used by 'with' statement, typically around
+    one request. Inside the scope Model.get() of cached models returns the same instance
+    for the same primary key:
+
+    with identity_map():
+        pass
+    '''
+    return _IdentityMapScope()
+
+
+def with_identity_map(func):
+    '''
+    Decorator that runs the function inside an identity map scope.
+    '''
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        with _IdentityMapScope():
+            return func(*args, **kw)
+    return _wrapper
+
+
 def _gen_sql(table_name, mappings):    # 生成 sql 语句函数
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
@@ -118,6 +217,34 @@ def _gen_sql(table_name, mappings):    # 生成 sql 语句函数
     return '\n'.join(sql)
 
 
+def _compile_sql(attrs, mappings, primary_key):    # 在创建类时预先生成增删改查的 sql 语句和字段元组，每次调用只需收集参数
+    table = attrs['__table__']
+    pk = primary_key.name
+    fields = sorted(mappings.iteritems(), key=lambda kv: kv[1]._order)    # 按字段定义的顺序排列
+    # (属性名, 原始默认值) 元组，默认值为 callable 时在使用时才调用:
+    insertable = tuple((k, v._default) for k, v in fields if v.insertable)
+    updatable = tuple((k, v._default) for k, v in fields if v.updatable)
+    attrs['__insert_fields__'] = insertable
+    attrs['__update_fields__'] = updatable
+    attrs['__select_sql__'] = 'select * from `%s` where `%s`=?' % (table, pk)
+    attrs['__insert_sql__'] = 'insert into `%s` (%s) values (%s)' % (
+        table, ','.join(['`%s`' % mappings[k].name for k, d in insertable]), ','.join(['?'] * len(insertable)))
+    attrs['__update_sql__'] = 'update `%s` set %s where `%s`=?' % (
+        table, ','.join(['`%s`=?' % mappings[k].name for k, d in updatable]), pk)
+    attrs['__delete_sql__'] = 'delete from `%s` where `%s`=?' % (table, pk)
+
+def _field_values(obj, fields):    # 按 fields 的顺序取出实例的值，缺少的字段使用默认值并写回实例
+    args = []
+    for k, default in fields:
+        if k in obj:
+            args.append(obj[k])
+        else:
+            arg = default() if callable(default) else default
+            obj[k] = arg
+            args.append(arg)
+    return args
+
+
 class ModelMetaclass(type):   # model 类的元类
     '''
     Metaclass for model objects.
@@ -166,6 +293,15 @@ class ModelMetaclass(type):   # model 类的元类
         attrs['__mappings__'] = mappings  # 将 attr['__mappings__'] 赋值为 mappings
         attrs['__primary_key__'] = primary_key    # 将 attr['__primary_key__'] 赋值为 primary_key
         attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)  # attrs['__sql__'] 赋值为 _gen_sql
+        _compile_sql(attrs, mappings, primary_key)
+        # __cache__ 为 True 或者 _ModelCache 的参数时，为这个 model 创建缓存，子类不会继承父类的缓存
+        cache = attrs.get('__cache__')
+        if isinstance(cache, dict):
+            attrs['__cache__'] = _ModelCache(**cache)
+        elif cache:
+            attrs['__cache__'] = _ModelCache()
+        else:
+            attrs['__cache__'] = None
         for trigger in _triggers:    # 如果 attrs 中不包括 _triggers 中的任意一项，则 attrs['trigger'] 为 None
             if not trigger in attrs:
                 attrs[trigger] = None
@@ -208,6 +344,19 @@ class Model(dict):    # Model 类
     >>> len(db.select('select * from user where id=10190'))
     0
     >>> import json
+    >>> class Blog(Model):
+    ...     __cache__ = dict(max_entries=100, ttl=30)
+    ...     id = IntegerField(primary_key=True)
+    ...     title = StringField()
+    >>> n = db.update('create table blog (id int primary key, title text)')
+    >>> r = Blog(id=1, title='cached').insert()
+    >>> Blog.get(1).title
+    u'cached'
+    >>> with identity_map():
+    ...     Blog.get(1) is Blog.get(1)
+    True
+    >>> Blog.cache_stats()['hits'], Blog.cache_stats()['identity_hits']
+    (1, 1)
     >>> print User().__sql__()
     -- generating SQL for user:
     create table `user` (
@@ -220,6 +369,7 @@ class Model(dict):    # Model 类
     );
     '''
     __metaclass__ = ModelMetaclass    # 指定 metaclass 为 ModelMetaclass
+    __cache__ = None
 
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
@@ -236,10 +386,51 @@ class Model(dict):    # Model 类
     @classmethod
     def get(cls, pk):
         '''
-        Get by primary key.
+        Get by primary key. If the model defines __cache__, the identity map of the current
+        scope and the process-wide cache are consulted first. Rows read inside a transaction
+        are not added to the process-wide cache.
+        '''
+        cache = cls.__cache__
+        if cache is None:
+            d = db.select_one(cls.__select_sql__, pk)
+            return cls(**d) if d else None    # 若 d 存在则返回实例化 d 并返回
+        objects = _identity_ctx.objects
+        if objects is not None:    # 在 identity map 的 scope 中，先从 identity map 中查找
+            obj = objects.get((cls, pk))
+            if obj is not None:
+                cache.identity_hits += 1
+                return obj
+        d = cache.get(pk)
+        if d is None:
+            d = db.select_one(cls.__select_sql__, pk)
+            if not d:
+                return None
+            d = dict(d)
+            if not db.in_transaction():    # 事务中读到的行可能还未提交或者会被回滚，不放入缓存
+                cache.put(pk, d)
+        obj = cls(**d)    # 每次都创建新的实例，不同的线程不会共用同一个实例
+        if objects is not None:
+            objects[(cls, pk)] = obj
+        return obj
+
+    @classmethod
+    def cache_stats(cls):
+        '''
+        Return hit/miss counters of the cache, or None if the model is not cached.
         '''
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None    # 若 d 存在则返回实例化 d 并返回
+        return cls.__cache__.stats() if cls.__cache__ is not None else None
+
+    def _evict(self):    # 从缓存和 identity map 中删除这条记录
+        cache = self.__cache__
+        if cache is None:
+            return
+        pk = getattr(self, self.__primary_key__.name, None)
+        cache.invalidate(pk)
+        if db.in_transaction():    # 事务结束前其他线程可能又缓存了修改前的行，提交或回滚后再删除一次
+            db.after_transaction(lambda: cache.invalidate(pk))
+        objects = _identity_ctx.objects
+        if objects is not None:
+            objects.pop((self.__class__, pk), None)
 
     @classmethod
     def find_first(cls, where, *args):
@@ -266,6 +457,18 @@ class Model(dict):    # Model 类
         L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
         return [cls(**d) for d in L]
 
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
+        '''
+        Find by where clause and yield results one by one, see db.select_iter().
+        '''
+        rows = db.select_iter('select * from `%s` %s' % (cls.__table__, where), *args, **kw)
+        try:
+            for d in rows:
+                yield cls(**d)
+        finally:
+            rows.close()
+
     @classmethod
     def count_all(cls):
         '''
@@ -283,45 +486,49 @@ class Model(dict):    # Model 类
 
     def update(self):    # 通过主键来更新一条记录
         self.pre_update and self.pre_update()   # 如果 self.pre_update 不为空则执行 self.pre_update
-        L = []
-        args = []
-        for k, v in self.__mappings__.iteritems():  # 依次迭代 __mappings__ 中所有 key 和 value
-            if v.updatable:    # 如果 v.updatable
-                if hasattr(self, k):  # 如果实例有名为 k 的属性
-                    arg = getattr(self, k)  # 获取 k 属性对应的值，并赋值给 args
-                else:    # 如果无名为 k 的属性
-                    arg = v.default    # 获取 k 属性对应的默认值，并赋值给 args
-                    setattr(self, k, arg)    # 将实例 k 属性的赋值为 args
-                L.append('`%s`=?' % k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self, pk))
-        db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        args = _field_values(self, self.__update_fields__)    # 可更新字段的值，缺少的字段使用默认值
+        args.append(getattr(self, self.__primary_key__.name))
+        db.update(self.__update_sql__, *args)
+        self._evict()
         return self
 
     def delete(self):    # 通过主键来删除一条记录
         self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
-        args = (getattr(self, pk),)
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        db.update(self.__delete_sql__, getattr(self, self.__primary_key__.name))
+        self._evict()
         return self
 
     def insert(self):    # 通过主键来插入一条记录
         self.pre_insert and self.pre_insert()
-        params = {}
-        for k, v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
+        db.update(self.__insert_sql__, *_field_values(self, self.__insert_fields__))
+        self._evict()
         return self
 
+    @classmethod
+    def insert_all(cls, instances, chunk_size=500):    # 批量插入多条记录
+        '''
+        Insert all instances with multi-row insert statements inside one transaction.
+        pre_insert and field defaults are applied to each instance like insert() does.
+        Return number of rows inserted.
+        '''
+        rows = []
+        inserted = []
+        columns = [cls.__mappings__[k].name for k, default in cls.__insert_fields__]
+        for obj in instances:
+            inserted.append(obj)
+            obj.pre_insert and obj.pre_insert()
+            rows.append(dict(zip(columns, _field_values(obj, cls.__insert_fields__))))
+        r = db.insert_many(cls.__table__, rows, chunk_size)
+        for obj in inserted:
+            obj._evict()
+        return r
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     db.create_engine('www-data', 'www-data', 'test')
     db.update('drop table if exists user')
+    db.update('drop table if exists blog')
     db.update('create table user (id int primary key, name text, email text, passwd text, last_modified real)')
     import doctest
 
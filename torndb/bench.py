@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Benchmarks for the torndb wrapper.
+
+Run with ``python bench.py``.  The benchmarks run against fakemysql, an
+in-process stand-in for MySQLdb, so they measure the wrapper and not the
+server; a MySQL server is not needed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import gc
+import sys
+import time
+
+import fakemysql
+server = fakemysql.install()
+import torndb
+
+
+def _timeit(func, number):
+    gc.collect()
+    start = time.time()
+    for _ in range(number):
+        func()
+    return (time.time() - start) / number
+
+
+def _objects_per_call(func, number):
+    # Objects still alive after each call, i.e. the size of its result.
+    gc.collect()
+    before = len(gc.get_objects())
+    keep = [func() for _ in range(number)]
+    gc.collect()
+    rv = (len(gc.get_objects()) - before) / number
+    del keep
+    return rv
+
+
+def _result_set(rows, columns):
+    description = [("column_%d" % i,) for i in range(columns)]
+    values = [tuple(u"value %d" % (r * columns + c) for c in range(columns))
+              for r in range(rows)]
+    return description, values
+
+
+def bench_rows(rows=100000, columns=10):
+    """Compares memory and build time of Row and CompactRow for one
+    result set.  Only the row containers are counted, the column values
+    are shared by both.
+    """
+    description, values = _result_set(rows, columns)
+    column_names = [d[0] for d in description]
+    print("rows (%d rows x %d columns):" % (rows, columns))
+
+    start = time.time()
+    result = [torndb.Row(zip(column_names, row)) for row in values]
+    elapsed = time.time() - start
+    size = sum(sys.getsizeof(r) for r in result)
+    print("  %-10s %8.1f MB  %8.3f s" % ("Row", size / 1048576, elapsed))
+    del result
+
+    start = time.time()
+    index = torndb.CompactRow.index(description)
+    result = [torndb.CompactRow(index, row) for row in values]
+    elapsed = time.time() - start
+    size = sys.getsizeof(index) + sum(
+        sys.getsizeof(r) + sys.getsizeof(r._values) for r in result)
+    print("  %-10s %8.1f MB  %8.3f s" % ("CompactRow", size / 1048576,
+                                         elapsed))
+
+
+def bench_decode(rows=20000, columns=50, number=3):
+    """Compares query() on a wide table with the driver converting every
+    value and with decode_columns, which converts column by column.
+    """
+    server.set_table(rows, columns)
+    server.latency = 0.0
+    print("decode (%d rows x %d columns):" % (rows, columns))
+    results = []
+    for decode_columns in (False, True):
+        db = torndb.Connection("localhost", "bench",
+                               decode_columns=decode_columns)
+        elapsed = _timeit(lambda: db.query("SELECT * FROM t"), number)
+        results.append(db.query("SELECT * FROM t"))
+        db.close()
+        print("  %-20s %8.3f s per 100k rows" % (
+            "decode_columns=%s" % decode_columns, elapsed * 100000 / rows))
+    assert results[0] == results[1]
+
+
+def _raw_query(connection, query, parameters=()):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, parameters)
+        return list(cursor)
+    finally:
+        cursor.close()
+
+
+def _raw_executemany(connection, query, parameters):
+    cursor = connection.cursor()
+    try:
+        cursor.executemany(query, parameters)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def bench_operations(rows=1000, number=200):
+    """Runs the main Connection operations against fakemysql and reports
+    rows per second, the overhead per call over using the driver directly,
+    and the objects each result keeps alive.
+    """
+    server.set_table(rows, 10)
+    server.latency = 0.0
+    db = torndb.Connection("localhost", "bench")
+    raw = db._db
+    parameters = [(i, "name %d" % i) for i in range(rows)]
+    operations = [
+        ("query", rows,
+         lambda: db.query("SELECT * FROM t"),
+         lambda: _raw_query(raw, "SELECT * FROM t")),
+        ("iter", rows,
+         lambda: list(db.iter("SELECT * FROM t")),
+         lambda: _raw_query(raw, "SELECT * FROM t")),
+        ("get", 1,
+         lambda: db.get("SELECT * FROM t WHERE id = %s", 1),
+         lambda: _raw_query(raw, "SELECT * FROM t WHERE id = %s", (1,))),
+        ("executemany", rows,
+         lambda: db.executemany_rowcount("INSERT INTO t VALUES (%s, %s)",
+                                         parameters),
+         lambda: _raw_executemany(raw, "INSERT INTO t VALUES (%s, %s)",
+                                  parameters)),
+        ("reconnect", 0, db.reconnect, None),
+    ]
+    print("operations (%d rows x 10 columns, %d calls):" % (rows, number))
+    print("  %-12s %12s %12s %14s %12s" % ("", "rows/s", "us/call",
+                                          "overhead us", "objects"))
+    for name, count, func, baseline in operations:
+        elapsed = _timeit(func, number)
+        overhead = "-"
+        if baseline is not None:
+            overhead = "%.1f" % ((elapsed - _timeit(baseline, number)) * 1e6)
+        print("  %-12s %12s %12.1f %14s %12.1f" % (
+            name, count and "%.0f" % (count / elapsed) or "-",
+            elapsed * 1e6, overhead, _objects_per_call(func, 20)))
+    db.close()
+
+
+def bench_pipeline(statements=8, latency=0.0005, number=50):
+    """Compares sequential get() calls with one pipeline() round trip,
+    with latency seconds per round trip to the server.
+    """
+    server.set_table(10, 10)
+    server.latency = latency
+    db = torndb.Connection("localhost", "bench", multi_statements=True)
+    query = "SELECT * FROM t WHERE id = %s"
+
+    def sequential():
+        return [db.get(query, i) for i in range(statements)]
+
+    def pipelined():
+        with db.pipeline() as pipeline:
+            for i in range(statements):
+                pipeline.get(query, i)
+        return pipeline.results
+
+    assert sequential() == pipelined()
+    print("%d gets with %.1f ms round trips:" % (statements, latency * 1e3))
+    for name, func in (("sequential", sequential), ("pipeline", pipelined)):
+        print("  %-10s %8.2f ms per request" % (name,
+                                                _timeit(func, number) * 1e3))
+    server.latency = 0.0
+    db.close()
+
+
+if __name__ == "__main__":
+    bench_rows()
+    bench_decode()
+    bench_operations()
+    bench_pipeline()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""An in-process stand-in for MySQLdb, used by bench.py to measure the
+overhead of the torndb wrapper itself without a MySQL server.
+
+It implements the part of the MySQLdb API that torndb uses.  Every
+SELECT returns the same generated table, or its first row if the query
+has a WHERE clause.  Writes only count rows.  Call install() before
+importing torndb::
+
+    import fakemysql
+    server = fakemysql.install(rows=1000, columns=10, latency=0.0005)
+    import torndb
+
+The settings of the returned Server can be changed at any time.  latency
+is slept once per round trip to the "server".  Like the driver, every
+value of a result set is converted when the result set is read, unless
+the connection was opened without result converters (torndb's
+decode_columns); then the raw bytes are returned.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import decimal
+import numbers
+import re
+import sys
+import time
+import types
+
+if sys.version_info[0] >= 3:
+    text_type = str
+else:
+    text_type = unicode
+
+
+class Error(Exception):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class OperationalError(DatabaseError):
+    pass
+
+
+class IntegrityError(DatabaseError):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+class FIELD_TYPE(object):
+    DECIMAL = 0
+    TINY = 1
+    LONG = 3
+    DOUBLE = 5
+    LONGLONG = 8
+    DATETIME = 12
+    VARCHAR = 15
+    NEWDECIMAL = 246
+    BLOB = 252
+    VAR_STRING = 253
+    STRING = 254
+
+
+class FLAG(object):
+    BINARY = 128
+
+
+class CLIENT(object):
+    MULTI_STATEMENTS = 65536
+    MULTI_RESULTS = 131072
+
+
+def _datetime(value):
+    date, time_ = value.split(" ", 1)
+    return datetime.datetime(*[int(x) for x in date.split("-") +
+                               time_.split(":")])
+
+
+# Decoders keyed by field type, encoders keyed by Python type, like
+# MySQLdb.converters.conversions.
+conversions = {
+    FIELD_TYPE.TINY: int,
+    FIELD_TYPE.LONG: int,
+    FIELD_TYPE.LONGLONG: int,
+    FIELD_TYPE.DOUBLE: float,
+    FIELD_TYPE.DECIMAL: decimal.Decimal,
+    FIELD_TYPE.NEWDECIMAL: decimal.Decimal,
+    FIELD_TYPE.DATETIME: _datetime,
+    FIELD_TYPE.BLOB: [],
+    FIELD_TYPE.STRING: [],
+    FIELD_TYPE.VAR_STRING: [],
+    FIELD_TYPE.VARCHAR: [],
+}
+
+# The column kinds of the generated table: field type, flags and the raw
+# value of row r.
+_KINDS = [
+    (FIELD_TYPE.LONG, 0, lambda r: str(r)),
+    (FIELD_TYPE.VAR_STRING, 0, lambda r: "name %d" % r),
+    (FIELD_TYPE.NEWDECIMAL, 0, lambda r: "%d.25" % r),
+    (FIELD_TYPE.DATETIME, 0,
+     lambda r: "2014-01-01 12:%02d:%02d" % (r // 60 % 60, r % 60)),
+    (FIELD_TYPE.BLOB, FLAG.BINARY, lambda r: "\x00\x01"),
+]
+
+
+class Server(object):
+    """The shared state of all fake connections."""
+    def __init__(self, rows=1000, columns=10, latency=0.0):
+        self.latency = latency
+        self.connects = 0
+        self.round_trips = 0
+        self.set_table(rows, columns)
+
+    def set_table(self, rows, columns):
+        """Generates the table every SELECT returns."""
+        layout = [_KINDS[c % len(_KINDS)] for c in range(columns)]
+        self.description = tuple(
+            ("column_%d" % c, field_type, None, None, None, None, 1)
+            for c, (field_type, flags, value) in enumerate(layout))
+        self.flags = tuple(flags for field_type, flags, value in layout)
+        self.raw_rows = [tuple(_raw(value(r))
+                               for field_type, flags, value in layout)
+                         for r in range(rows)]
+        self.decoders = tuple(_decoder(field_type, flags)
+                              for field_type, flags, value in layout)
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def _raw(value):
+    # Values are sent by the server as bytes.
+    return value if isinstance(value, bytes) else value.encode("utf8")
+
+
+def _decoder(field_type, flags):
+    # What MySQLdb with torndb.CONVERSIONS and use_unicode returns.
+    if field_type in (FIELD_TYPE.BLOB, FIELD_TYPE.STRING,
+                      FIELD_TYPE.VAR_STRING, FIELD_TYPE.VARCHAR):
+        if flags & FLAG.BINARY:
+            return lambda value: value
+        return lambda value: value.decode("utf8")
+    convert = conversions[field_type]
+    if bytes is str:
+        return convert
+    # On Python 3 the driver passes the other values to their converter as
+    # str.
+    return lambda value: convert(value.decode("ascii"))
+
+
+server = Server()
+
+
+class Connection(object):
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.open = True
+        charset = kwargs.get("charset", "utf8")
+        self.encoding = {"utf8mb4": "utf8", "utf8mb3": "utf8"}.get(charset,
+                                                                   charset)
+        # torndb's decode_columns passes the encoders only.
+        self.raw = not any(isinstance(k, int) for k in kwargs.get("conv", {1: 0}))
+        self.multi_statements = bool(kwargs.get("client_flag", 0) &
+                                     CLIENT.MULTI_STATEMENTS)
+        server.connects += 1
+        server.round_trip()
+
+    def autocommit(self, on):
+        pass
+
+    def cursor(self, cursorclass=None):
+        return (cursorclass or Cursor)(self)
+
+    def literal(self, value):
+        # Like the driver, returns the escaped value as bytes in the
+        # connection charset.
+        if value is None:
+            return b"NULL"
+        if isinstance(value, numbers.Number):
+            return str(value).encode("ascii")
+        if isinstance(value, bytes):
+            value = value.decode(self.encoding)
+        value = text_type(value).replace("\\", "\\\\").replace("'", "\\'")
+        return (u"'%s'" % value).encode(self.encoding)
+
+    def ping(self, reconnect=False):
+        if not self.open:
+            raise OperationalError(2006, "MySQL server has gone away")
+        server.round_trip()
+
+    def commit(self):
+        server.round_trip()
+
+    def rollback(self):
+        server.round_trip()
+
+    def close(self):
+        self.open = False
+
+
+def connect(**kwargs):
+    return Connection(**kwargs)
+
+
+_where_re = re.compile(r"\bwhere\b", re.I)
+
+
+class Cursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.description_flags = None
+        self.rowcount = -1
+        self.lastrowid = None
+        self._rows = []
+        self._pos = 0
+        self._pending = []
+
+    def execute(self, query, args=None):
+        # Like the driver, the query is encoded with the connection charset
+        # and formatted in bytes.
+        if not self.connection.open:
+            raise OperationalError(2006, "MySQL server has gone away")
+        encoding = self.connection.encoding
+        if isinstance(query, text_type):
+            query = query.encode(encoding)
+        if args is not None:
+            literal = self.connection.literal
+            if isinstance(args, dict):
+                query = query % dict(
+                    (k.encode(encoding) if isinstance(k, text_type) else k,
+                     literal(v)) for k, v in args.items())
+            else:
+                query = query % tuple(literal(v) for v in args)
+        server.round_trip()
+        statements = [query]
+        if self.connection.multi_statements:
+            statements = query.split(b";\n")
+        self._pending = [statement.decode(encoding)
+                         for statement in statements[1:]]
+        self._result(statements[0].decode(encoding))
+        return self.rowcount
+
+    def executemany(self, query, args):
+        if not self.connection.open:
+            raise OperationalError(2006, "MySQL server has gone away")
+        server.round_trip()
+        self.rowcount = sum(1 for _ in args)
+        self.lastrowid = self.rowcount
+        self.description = None
+        return self.rowcount
+
+    def nextset(self):
+        if not self._pending:
+            return None
+        self._result(self._pending.pop(0))
+        return True
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._rows = []
+        self._pending = []
+
+    def _result(self, query):
+        self._pos = 0
+        if query.lstrip()[:6].lower() != "select":
+            self.description = None
+            self.description_flags = None
+            self._rows = []
+            self.rowcount = 1
+            self.lastrowid = 1
+            return
+        self.description = server.description
+        self.description_flags = server.flags
+        rows = server.raw_rows
+        if _where_re.search(query):
+            rows = rows[:1]
+        if not self.connection.raw:
+            decoders = server.decoders
+            rows = [tuple(decode(value) for decode, value in zip(decoders, row))
+                    for row in rows]
+        self._rows = rows
+        self.rowcount = len(rows)
+
+
+class SSCursor(Cursor):
+    pass
+
+
+def install(rows=1000, columns=10, latency=0.0):
+    """Registers this module as MySQLdb and returns its Server."""
+    module = sys.modules[__name__]
+    constants = types.ModuleType("MySQLdb.constants")
+    constants.FIELD_TYPE = FIELD_TYPE
+    constants.FLAG = FLAG
+    constants.CLIENT = CLIENT
+    converters = types.ModuleType("MySQLdb.converters")
+    converters.conversions = conversions
+    cursors = types.ModuleType("MySQLdb.cursors")
+    cursors.Cursor = Cursor
+    cursors.SSCursor = SSCursor
+    module.constants = constants
+    module.converters = converters
+    module.cursors = cursors
+    sys.modules.update({
+        "MySQLdb": module,
+        "MySQLdb.constants": constants,
+        "MySQLdb.converters": converters,
+        "MySQLdb.cursors": cursors,
+    })
+    server.latency = latency
+    server.set_table(rows, columns)
+    return server
@@ -22,15 +22,33 @@ as torndb.
 
 from __future__ import absolute_import, division, with_statement
 
+import bisect
+import collections
+import contextlib
 import copy
+import functools
+import itertools
 import logging
 import os
+import random
+import re
+import sys
+import threading
 import time
+import weakref
+
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    # Only needed by AsyncConnection, which requires Python 3.
+    asyncio = None
 
 try:
     import MySQLdb.constants
     import MySQLdb.converters
     import MySQLdb.cursors
+    from MySQLdb.constants import CLIENT
 except ImportError:
     # If MySQLdb isn't available this module won't actually be useable,
     # but we want it to at least be importable on readthedocs.org,
@@ -43,6 +61,29 @@ except ImportError:
 version = "0.3"
 version_info = (0, 3, 0, 0)
 
+_idempotent_re = re.compile(r"\s*(?:select|show|describe|desc|explain)\b",
+                            re.I)
+_locking_read_re = re.compile(r"\bfor\s+update\b|\block\s+in\s+share\s+mode\b",
+                              re.I)
+
+
+def _retry_read(method):
+    # Runs an idempotent read a second time on a fresh connection if the
+    # first attempt lost the connection (_execute closes it then).
+    @functools.wraps(method)
+    def wrapper(self, query, *parameters, **kwparameters):
+        try:
+            return method(self, query, *parameters, **kwparameters)
+        except OperationalError:
+            if (not self.retry_reads or self._db is not None or
+                    not _idempotent_re.match(query) or
+                    _locking_read_re.search(query)):
+                raise
+            logging.warning("Retrying read on %s after a lost connection",
+                            self.host)
+            return method(self, query, *parameters, **kwparameters)
+    return wrapper
+
 class Connection(object):
     """A lightweight wrapper around MySQLdb DB-API connections.
     The main value we provide is wrapping rows in a dict/object so that
@@ -59,18 +100,54 @@ class Connection(object):
     any other mode including blank (None) thereby explicitly clearing the SQL mode.
     Arguments read_timeout and write_timeout can be passed using kwargs, if
     MySQLdb version >= 1.2.5 and MySQL version > 5.1.12.
+    If keepalive_interval is given, a connection that has been idle for
+    longer than that many seconds is pinged (and reopened if the server
+    dropped it) before it is used again; ConnectionPool additionally pings
+    its idle connections in the background.  With retry_reads=True a
+    SELECT (or SHOW, DESCRIBE, EXPLAIN) that fails because the connection
+    was lost is run once more on a new connection.  Do not enable it for
+    connections used with explicit transactions, the retried read would run
+    outside of the lost transaction.
+    With decode_columns=True the driver returns the raw column values and
+    torndb converts them itself: the converter of every column is looked
+    up once per result set from CONVERSIONS and applied column by column
+    to each fetched batch.  Whether that is faster than the driver depends
+    on the driver, measure it with bench.py.
+    multi_statements=True opens the connection with
+    CLIENT.MULTI_STATEMENTS so that pipeline() can send several queries in
+    one round trip.
     """
     def __init__(self, host, database, user=None, password=None,
                  max_idle_time=7 * 3600, connect_timeout=0,
                  time_zone="+0:00", charset = "utf8", sql_mode="TRADITIONAL",
-                 **kwargs):
+                 query_cache=None, query_stats=None, keepalive_interval=None,
+                 retry_reads=False, decode_columns=False,
+                 multi_statements=False, **kwargs):
         self.host = host
         self.database = database
         self.max_idle_time = float(max_idle_time)
+        self.keepalive_interval = keepalive_interval
+        self.retry_reads = retry_reads
+        self.reconnects = 0
+        self.pings = 0
+        self.query_cache = query_cache
+        self.query_stats = query_stats
+        self.decode_columns = decode_columns
+        self.multi_statements = multi_statements
+        self._codec = _CHARSET_CODECS.get(charset, charset)
 
         args = dict(conv=CONVERSIONS, use_unicode=True, charset=charset,
                     db=database, init_command=('SET time_zone = "%s"' % time_zone),
                     connect_timeout=connect_timeout, sql_mode=sql_mode, **kwargs)
+        if decode_columns:
+            # Keep the parameter encoders only, results come back raw.
+            args["conv"] = dict((k, v) for k, v in CONVERSIONS.items()
+                                if not isinstance(k, int))
+            args["use_unicode"] = False
+        if multi_statements:
+            args["client_flag"] = (args.get("client_flag", 0) |
+                                   CLIENT.MULTI_STATEMENTS |
+                                   CLIENT.MULTI_RESULTS)
         if user is not None:
             args["user"] = user
         if password is not None:
@@ -92,6 +169,7 @@ class Connection(object):
         self._db = None
         self._db_args = args
         self._last_use_time = time.time()
+        self._connected = False
         try:
             self.reconnect()
         except Exception:
@@ -112,6 +190,27 @@ class Connection(object):
         self.close()
         self._db = MySQLdb.connect(**self._db_args)
         self._db.autocommit(True)
+        if self._connected:
+            self.reconnects += 1
+        self._connected = True
+
+    def ping(self):
+        """Checks the connection with a round trip to the server and
+        reopens it if it was lost.  Returns False if it had to be reopened.
+        """
+        self.pings += 1
+        alive = self._db is not None
+        if alive:
+            try:
+                self._db.ping()
+            except OperationalError:
+                logging.warning("Lost connection to MySQL on %s, reconnecting",
+                                self.host)
+                alive = False
+        if not alive:
+            self.reconnect()
+        self._last_use_time = time.time()
+        return alive
 
     def iter(self, query, *parameters, **kwparameters):
         """Returns an iterator for the given query and parameters."""
@@ -120,21 +219,126 @@ class Connection(object):
         try:
             self._execute(cursor, query, parameters, kwparameters)
             column_names = [d[0] for d in cursor.description]
-            for row in cursor:
+            for row in self._iter_rows(cursor):
                 yield Row(zip(column_names, row))
         finally:
             cursor.close()
 
+    def iter_batches(self, query, parameters=(), batch_size=1000,
+                     format="rows"):
+        """Returns an iterator over batches of at most batch_size rows for
+        the given query and parameters (a sequence or a dict), read from a
+        server side cursor without building a Row per row.
+        With format="rows" every batch is a list of tuples.  With
+        format="columns" every batch is a Row mapping column names to
+        NumPy arrays, or to tuples if NumPy is not installed.
+        """
+        if format not in ("rows", "columns"):
+            raise ValueError("format must be 'rows' or 'columns'")
+        array = None
+        if format == "columns":
+            try:
+                import numpy
+                array = numpy.array
+            except ImportError:
+                pass
+        self._ensure_connected()
+        cursor = MySQLdb.cursors.SSCursor(self._db)
+        try:
+            if isinstance(parameters, dict):
+                self._execute(cursor, query, (), parameters)
+            else:
+                self._execute(cursor, query, parameters, {})
+            column_names = [d[0] for d in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if self.decode_columns:
+                    columns = self._decode_columns(cursor, rows)
+                    if format == "rows":
+                        yield list(zip(*columns))
+                        continue
+                    if array is None:
+                        columns = [tuple(column) for column in columns]
+                elif format == "rows":
+                    yield list(rows)
+                    continue
+                else:
+                    columns = zip(*rows)
+                if array is not None:
+                    columns = [array(column) for column in columns]
+                yield Row(zip(column_names, columns))
+        finally:
+            cursor.close()
+
+    @_retry_read
     def query(self, query, *parameters, **kwparameters):
         """Returns a row list for the given query and parameters."""
         cursor = self._cursor()
         try:
             self._execute(cursor, query, parameters, kwparameters)
             column_names = [d[0] for d in cursor.description]
-            return [Row(zip(column_names, row)) for row in cursor]
+            return [Row(zip(column_names, row))
+                    for row in self._fetchall(cursor)]
+        finally:
+            cursor.close()
+
+    @_retry_read
+    def query_compact(self, query, *parameters, **kwparameters):
+        """Like query(), but returns CompactRow objects that share one
+        column index instead of a dict per row.
+        """
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            index = CompactRow.index(cursor.description)
+            return [CompactRow(index, row) for row in self._fetchall(cursor)]
         finally:
             cursor.close()
 
+    def iter_compact(self, query, *parameters, **kwparameters):
+        """Like iter(), but yields CompactRow objects."""
+        self._ensure_connected()
+        cursor = MySQLdb.cursors.SSCursor(self._db)
+        try:
+            self._execute(cursor, query, parameters, kwparameters)
+            index = CompactRow.index(cursor.description)
+            for row in self._iter_rows(cursor):
+                yield CompactRow(index, row)
+        finally:
+            cursor.close()
+
+    def cached_query(self, ttl, query, *parameters, **kwparameters):
+        """Like query(), but serves the result from the query_cache given
+        to the constructor for up to ttl seconds.  Writes through this
+        connection (or any other sharing the cache) to a table the query
+        reads from drop the cached result; a write whose tables cannot be
+        determined drops all cached results.  Without a cache this is the
+        same as query().
+        """
+        cache = self.query_cache
+        if cache is None:
+            return self.query(query, *parameters, **kwparameters)
+        key = cache.key(query, parameters, kwparameters)
+        if key is None:    # unhashable parameters
+            return self.query(query, *parameters, **kwparameters)
+        rows = cache.get(key)
+        if rows is None:
+            rows = self.query(query, *parameters, **kwparameters)
+            cache.put(key, rows, ttl, _read_tables(query))
+        return [Row(row) for row in rows]
+
+    def cached_get(self, ttl, query, *parameters, **kwparameters):
+        """Like get(), but uses cached_query()."""
+        rows = self.cached_query(ttl, query, *parameters, **kwparameters)
+        if not rows:
+            return None
+        elif len(rows) > 1:
+            raise Exception("Multiple rows returned for Database.get() query")
+        else:
+            return rows[0]
+
     def get(self, query, *parameters, **kwparameters):
         """Returns the (singular) row returned by the given query.
         If the query has no results, returns None.  If it has
@@ -148,6 +352,62 @@ class Connection(object):
         else:
             return rows[0]
 
+    def pipeline(self):
+        """Returns a context that collects read queries and runs them
+        together when the block ends::
+            with db.pipeline() as pipeline:
+                pipeline.get("SELECT * FROM users WHERE id = %s", user_id)
+                pipeline.query("SELECT * FROM articles LIMIT 10")
+            user, articles = pipeline.results
+        With multi_statements=True all queries are sent as one
+        multi-statement string in a single round trip; otherwise they run
+        one after the other, with the same results.
+        """
+        return _Pipeline(self)
+
+    def _run_pipeline(self, queries):
+        # Runs the queued (query, parameters, kwparameters) of a pipeline as
+        # one statement and returns the Row list of every result set.
+        self._ensure_connected()
+        db = self._db
+        encoding = getattr(db, "encoding", self._codec)
+
+        def encode(value):
+            if isinstance(value, bytes):
+                return value
+            return value.encode(encoding)
+
+        statements = []
+        for query, parameters, kwparameters in queries:
+            # Formatted like the driver formats a single query: encoded
+            # with the connection charset and formatted in bytes with the
+            # literals, which also turns %% into % without parameters.
+            query = encode(query)
+            if kwparameters:
+                query = query % dict((encode(k), encode(db.literal(v)))
+                                     for k, v in kwparameters.items())
+            else:
+                query = query % tuple(encode(db.literal(v))
+                                      for v in parameters)
+            statements.append(query.rstrip().rstrip(b";"))
+        # The driver %-formats the statement even without parameters.
+        statement = b";\n".join(statements).replace(b"%", b"%%")
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, statement, (), {})
+            results = []
+            while True:
+                if cursor.description is None:
+                    results.append([])
+                else:
+                    column_names = [d[0] for d in cursor.description]
+                    results.append([Row(zip(column_names, row))
+                                    for row in self._fetchall(cursor)])
+                if len(results) == len(statements) or not cursor.nextset():
+                    return results
+        finally:
+            cursor.close()
+
     # rowcount is a more reasonable default return value than lastrowid,
     # but for historical compatibility execute() must return lastrowid.
     def execute(self, query, *parameters, **kwparameters):
@@ -162,6 +422,7 @@ class Connection(object):
             return cursor.lastrowid
         finally:
             cursor.close()
+            self._invalidate(query)
 
     def execute_rowcount(self, query, *parameters, **kwparameters):
         """Executes the given query, returning the rowcount from the query."""
@@ -171,6 +432,7 @@ class Connection(object):
             return cursor.rowcount
         finally:
             cursor.close()
+            self._invalidate(query)
 
     def executemany(self, query, parameters):
         """Executes the given query against all the given param sequences.
@@ -184,10 +446,11 @@ class Connection(object):
         """
         cursor = self._cursor()
         try:
-            cursor.executemany(query, parameters)
+            self._executemany(cursor, query, parameters)
             return cursor.lastrowid
         finally:
             cursor.close()
+            self._invalidate(query)
 
     def executemany_rowcount(self, query, parameters):
         """Executes the given query against all the given param sequences.
@@ -195,16 +458,82 @@ class Connection(object):
         """
         cursor = self._cursor()
         try:
-            cursor.executemany(query, parameters)
+            self._executemany(cursor, query, parameters)
             return cursor.rowcount
         finally:
             cursor.close()
+            self._invalidate(query)
+
+    def executemany_chunked(self, query, parameters, batch_size=1000,
+                            max_bytes=None, transaction=False,
+                            progress=None):
+        """Executes the given query against the param sequences of any
+        iterable (including generators), batch_size rows per executemany()
+        call, and returns the total rowcount.
+        If max_bytes is given a batch is also cut when the estimated size of
+        its parameters reaches it, which keeps the statements below the
+        server's max_allowed_packet.  With transaction=True every batch is
+        committed in its own transaction.  progress, if given, is called
+        after every batch as progress(rows, elapsed_seconds, rows_per_second).
+        """
+        start = time.time()
+        total = 0
+        rows = 0
+        batch = []
+        size = 0
+        for row in parameters:
+            batch.append(row)
+            if max_bytes is not None:
+                size += _estimate_size(row)
+            if len(batch) >= batch_size or (max_bytes is not None and
+                                            size >= max_bytes):
+                total += self._executemany_batch(query, batch, transaction)
+                rows += len(batch)
+                batch = []
+                size = 0
+                if progress is not None:
+                    elapsed = time.time() - start
+                    progress(rows, elapsed, rows / elapsed if elapsed else 0.0)
+        if batch:
+            total += self._executemany_batch(query, batch, transaction)
+            rows += len(batch)
+            if progress is not None:
+                elapsed = time.time() - start
+                progress(rows, elapsed, rows / elapsed if elapsed else 0.0)
+        return total
 
     update = delete = execute_rowcount
     updatemany = executemany_rowcount
 
     insert = execute_lastrowid
     insertmany = executemany_lastrowid
+    insertmany_chunked = executemany_chunked
+
+    def _executemany_batch(self, query, batch, transaction):
+        cursor = self._cursor()
+        try:
+            if not transaction:
+                self._executemany(cursor, query, batch)
+                return cursor.rowcount
+            cursor.execute("BEGIN")
+            try:
+                self._executemany(cursor, query, batch)
+            except Exception:
+                self._db.rollback()
+                raise
+            self._db.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+            self._invalidate(query)
+
+    def _invalidate(self, query):
+        if self.query_cache is not None:
+            tables = _write_tables(query)
+            if tables is None:
+                self.query_cache.clear()
+            elif tables:
+                self.query_cache.invalidate_tables(tables)
 
     def _ensure_connected(self):
         # Mysql by default closes client connections that are idle for
@@ -215,19 +544,1231 @@ class Connection(object):
         if (self._db is None or
             (time.time() - self._last_use_time > self.max_idle_time)):
             self.reconnect()
+        elif (self.keepalive_interval is not None and
+              time.time() - self._last_use_time > self.keepalive_interval):
+            self.ping()
         self._last_use_time = time.time()
 
     def _cursor(self):
         self._ensure_connected()
         return self._db.cursor()
 
+    def _fetchall(self, cursor):
+        # All rows of the result set, decoded if decode_columns is on.
+        if not self.decode_columns:
+            return cursor
+        rows = cursor.fetchall()
+        if not rows:
+            return rows
+        return list(zip(*self._decode_columns(cursor, rows)))
+
+    def _iter_rows(self, cursor, batch_size=1000):
+        # Like _fetchall() for server side cursors, decodes in batches.
+        if not self.decode_columns:
+            return cursor
+        return self._iter_decoded(cursor, batch_size)
+
+    def _iter_decoded(self, cursor, batch_size):
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in zip(*self._decode_columns(cursor, rows)):
+                yield row
+
+    def _decode_columns(self, cursor, rows):
+        # Returns the columns of a batch of raw rows, converted.
+        description = cursor.description
+        flags = getattr(cursor, "description_flags", None)
+        if flags is None:
+            flags = (0,) * len(description)
+        decoders = _column_decoders(description, flags, self._codec)
+        columns = list(zip(*rows))
+        for i, decode in enumerate(decoders):
+            if decode is not None:
+                columns[i] = [None if v is None else decode(v)
+                              for v in columns[i]]
+        return columns
+
     def _execute(self, cursor, query, parameters, kwparameters):
+        stats = self.query_stats
+        start = time.time() if stats is not None else None
         try:
             return cursor.execute(query, kwparameters or parameters)
         except OperationalError:
             logging.error("Error connecting to MySQL on %s", self.host)
             self.close()
             raise
+        finally:
+            if start is not None:
+                stats.record(query, cursor.rowcount, time.time() - start,
+                             kwparameters or parameters)
+
+    def _executemany(self, cursor, query, parameters):
+        stats = self.query_stats
+        start = time.time() if stats is not None else None
+        try:
+            return cursor.executemany(query, parameters)
+        finally:
+            if start is not None:
+                stats.record(query, cursor.rowcount, time.time() - start,
+                             parameters)
+
+
+class _Pipeline(object):
+    """Queued queries of Connection.pipeline."""
+    def __init__(self, connection):
+        self._connection = connection
+        self._queries = []
+        self._single = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.execute()
+
+    def query(self, query, *parameters, **kwparameters):
+        """Queues a query whose result is a row list."""
+        self._queries.append((query, parameters, kwparameters))
+        self._single.append(False)
+
+    def get(self, query, *parameters, **kwparameters):
+        """Queues a query whose result is a single row, see
+        Connection.get.
+        """
+        self._queries.append((query, parameters, kwparameters))
+        self._single.append(True)
+
+    def execute(self):
+        """Runs the queued queries and returns their results in order,
+        also stored in the results attribute.
+        """
+        queries, self._queries = self._queries, []
+        single, self._single = self._single, []
+        self.results = self._run(self._connection, queries, single)
+        return self.results
+
+    @staticmethod
+    def _run(connection, queries, single):
+        if not queries:
+            results = []
+        elif connection.multi_statements:
+            results = connection._run_pipeline(queries)
+        else:
+            results = [connection.query(query, *parameters, **kwparameters)
+                       for query, parameters, kwparameters in queries]
+        for i, rows in enumerate(results):
+            if single[i]:
+                if len(rows) > 1:
+                    raise Exception("Multiple rows returned for "
+                                    "Database.get() query")
+                results[i] = rows[0] if rows else None
+        return results
+
+
+_read_tables_re = re.compile(
+    r"\b(?:from|join)\s+((?:`?[\w$]+`?\.)?`?[\w$]+`?"
+    r"(?:\s*,\s*(?:`?[\w$]+`?\.)?`?[\w$]+`?)*)", re.I)
+_TABLE = r"(?:`[^`]+`|[\w$]+)(?:\s*\.\s*(?:`[^`]+`|[\w$]+))?"
+_leading_comments_re = re.compile(
+    r"^(?:\s+|/\*.*?\*/|(?:--|#)[^\n]*(?:\n|$))*", re.S)
+_statement_tables_re = re.compile(
+    r"(?:^|,|\bjoin\b|\bto\b)\s*(" + _TABLE + r")", re.I)
+_write_tables_re = re.compile(
+    r"(?:insert|replace)(?:\s+(?:low_priority|delayed|high_priority|ignore))*"
+    r"\s+(?:into\s+)?(?P<insert>" + _TABLE + r")"
+    r"|update(?:\s+(?:low_priority|ignore))*\s+(?P<update>.*?)\s+set\b"
+    r"|delete(?:\s+(?:low_priority|quick|ignore))*\s+(?P<delete>.*?)"
+    r"(?:\s+(?:where|order\s+by|limit)\b|$)"
+    r"|(?:truncate|alter|drop|rename)\s+(?:table\s+)?(?:if\s+exists\s+)?"
+    r"(?P<ddl>.*?)\s*(?:;|$)",
+    re.I | re.S)
+# Statements that change no table.
+_read_only_re = re.compile(
+    r"(?:select|show|describe|desc|explain|set|begin|start|commit|rollback|"
+    r"savepoint|release|use|do|lock|unlock)\b", re.I)
+
+
+def _table_name(name):
+    # `db`.`table` -> table
+    return name.split(".")[-1].strip().strip("`").lower()
+
+
+def _read_tables(query):
+    # Names of the tables a SELECT reads from.
+    tables = set()
+    for match in _read_tables_re.finditer(query):
+        for name in match.group(1).split(","):
+            tables.add(_table_name(name))
+    return tables
+
+
+def _write_tables(query):
+    # Names of the tables a statement changes: an empty set if it changes
+    # none, or None if they cannot be determined.
+    query = _leading_comments_re.sub("", query, count=1)
+    match = _write_tables_re.match(query)
+    if match is None:
+        return set() if _read_only_re.match(query) else None
+    if match.group("insert"):
+        return set([_table_name(match.group("insert"))])
+    # The table references of a multi-table UPDATE or DELETE, including
+    # the tables that are only read; both sides of FROM and USING.
+    references = re.split(r"\b(?:from|using)\b", match.group(
+        "update") or match.group("delete") or match.group("ddl") or "",
+        flags=re.I)
+    tables = set()
+    for reference in references:
+        for name in _statement_tables_re.findall(reference.strip()):
+            tables.add(_table_name(name))
+    return tables or None
+
+
+def _rows_size(rows):
+    # Rough number of bytes a list of rows takes in memory.
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row.values():
+            size += sys.getsizeof(value)
+    return size
+
+
+class QueryCache(object):
+    """A thread-safe cache of query results that can be shared by several
+    connections, see Connection.cached_query.  Results are evicted when
+    their ttl passes, when a write to one of the tables they read from is
+    executed, or least recently used first when the estimated size of all
+    results exceeds max_bytes.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> (expires, size, rows, tables)
+        self._tables = {}  # table -> set of keys
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(query, parameters, kwparameters):
+        """Returns the cache key for a query or None if the parameters
+        are not hashable.
+        """
+        key = (" ".join(query.split()), tuple(parameters),
+               tuple(sorted(kwparameters.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, rows, ttl, tables):
+        size = _rows_size(rows)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + ttl, size, rows, tables)
+            self._bytes += size
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_tables(self, tables):
+        """Drops all results read from any of the given tables."""
+        with self._lock:
+            for table in tables:
+                for key in list(self._tables.get(table, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tables.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._entries), bytes=self._bytes,
+                        hits=self.hits, misses=self.misses,
+                        invalidations=self.invalidations)
+
+    def _remove(self, key):
+        expires, size, rows, tables = self._entries.pop(key)
+        self._bytes -= size
+        for table in tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+
+_literals_re = re.compile(
+    r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"|\b\d+(?:\.\d+)?\b")
+_in_list_re = re.compile(r"\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)")
+
+
+def _normalize(query):
+    # Collapses whitespace and replaces literals and IN lists with
+    # placeholders so that statements that only differ in their values
+    # share one entry.
+    if bytes is not str and isinstance(query, bytes):
+        query = query.decode("utf8", "replace")  # a pipeline statement
+    query = _literals_re.sub("?", " ".join(query.split()))
+    return _in_list_re.sub("(...)", query)
+
+
+class QueryStats(object):
+    """Per-statement execution statistics that can be shared by several
+    connections, see the query_stats argument of Connection.
+
+    Statements are grouped by their normalized text and for each one the
+    number of calls, rows and a latency histogram are kept.  Percentiles
+    are estimated from the histogram, so they are accurate to one bucket
+    (the buckets double from 0.1 ms up to about 100 s).  If slow_threshold
+    (in seconds) and on_slow are given, on_slow(query, parameters, elapsed)
+    is called for every statement that took at least slow_threshold.
+    """
+    buckets = tuple(0.0001 * 2 ** i for i in range(21))
+
+    def __init__(self, slow_threshold=None, on_slow=None):
+        self.slow_threshold = slow_threshold
+        self.on_slow = on_slow
+        self._stats = {}  # normalized query -> [calls, rows, total, max, histogram]
+        self._normalized = {}
+        self._lock = threading.Lock()
+
+    def record(self, query, rows, elapsed, parameters=None):
+        normalized = self._normalized.get(query)
+        if normalized is None:
+            if len(self._normalized) > 10000:
+                self._normalized.clear()
+            normalized = self._normalized[query] = _normalize(query)
+        bucket = bisect.bisect_left(self.buckets, elapsed)
+        with self._lock:
+            entry = self._stats.get(normalized)
+            if entry is None:
+                entry = self._stats[normalized] = [
+                    0, 0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+            entry[0] += 1
+            entry[1] += max(rows or 0, 0)
+            entry[2] += elapsed
+            entry[3] = max(entry[3], elapsed)
+            entry[4][bucket] += 1
+        if (self.on_slow is not None and self.slow_threshold is not None
+                and elapsed >= self.slow_threshold):
+            self.on_slow(query, parameters, elapsed)
+
+    def dump(self, reset=False):
+        """Returns a dict mapping each normalized statement to a dict with
+        its calls, rows, total, mean, max, p50, p95 and p99 (times in
+        seconds).  With reset=True the statistics are cleared as well.
+        """
+        with self._lock:
+            stats = self._stats
+            if reset:
+                self._stats = {}
+            else:
+                stats = dict((k, v[:4] + [list(v[4])])
+                             for k, v in stats.items())
+        result = {}
+        for query, (calls, rows, total, max_time, histogram) in stats.items():
+            result[query] = dict(
+                calls=calls, rows=rows, total=total, mean=total / calls,
+                max=max_time,
+                p50=self._percentile(histogram, calls, 0.50, max_time),
+                p95=self._percentile(histogram, calls, 0.95, max_time),
+                p99=self._percentile(histogram, calls, 0.99, max_time))
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def _percentile(self, histogram, calls, fraction, max_time):
+        # Upper bound of the bucket holding the percentile, but never more
+        # than the slowest call seen.
+        wanted = fraction * calls
+        seen = 0
+        for bound, count in zip(self.buckets, histogram):
+            seen += count
+            if seen >= wanted:
+                return min(bound, max_time)
+        return max_time
+
+
+# MySQL character set names Python does not know.
+_CHARSET_CODECS = {"utf8mb4": "utf8", "utf8mb3": "utf8", "latin1": "cp1252",
+                   "binary": "latin1"}
+
+_decoders = {}
+
+
+def _column_decoders(description, flags, codec):
+    # The converter of every column of a result set, or None where the raw
+    # value is returned as is.  Computed once per distinct column layout.
+    key = (tuple(d[1] for d in description), tuple(flags), codec)
+    decoders = _decoders.get(key)
+    if decoders is None:
+        if len(_decoders) > 1000:
+            _decoders.clear()
+        decoders = _decoders[key] = tuple(
+            _column_decoder(d[1], f, codec)
+            for d, f in zip(description, flags))
+    return decoders
+
+
+def _column_decoder(field_type, flags, codec):
+    # Picks the converter the same way the driver does: a list holds
+    # (flag mask, converter) pairs and the first pair whose mask is None or
+    # matches the column flags wins.  Text columns without a binary
+    # converter are decoded with the connection character set, as the
+    # driver does with use_unicode.
+    decoder = CONVERSIONS.get(field_type)
+    if isinstance(decoder, list):
+        for mask, func in decoder:
+            if mask is None or mask & flags:
+                decoder = func
+                break
+        else:
+            decoder = None
+        if decoder is None and field_type in _TEXT_TYPES:
+            return lambda value: value.decode(codec)
+    if decoder is str:
+        return None
+    if bytes is not str and decoder not in (int, float):
+        # On Python 3 the driver passes str to converters, int() and
+        # float() accept the raw bytes as well.
+        return lambda value: decoder(value.decode("ascii"))
+    return decoder
+
+
+def _estimate_size(row):
+    # Rough number of bytes the parameters of one row add to a statement.
+    if isinstance(row, dict):
+        row = row.values()
+    return sum(len(value) if hasattr(value, "__len__") else 8
+               for value in row)
+
+
+def _pooled(name):
+    # Builds a ConnectionPool method that runs the Connection method of the
+    # same name on a connection checked out for the duration of the call.
+    def method(self, *args, **kwargs):
+        connection = self._checkout()
+        try:
+            return getattr(connection, name)(*args, **kwargs)
+        finally:
+            self._checkin(connection)
+    method.__name__ = name
+    method.__doc__ = getattr(Connection, name).__doc__
+    return method
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free within wait_timeout."""
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of Connection objects with the same interface.
+    Typical usage::
+        db = torndb.ConnectionPool("localhost", "mydatabase",
+                                   max_connections=20)
+        for article in db.query("SELECT * FROM articles"):
+            print article.title
+    Every call checks a connection out of the pool and returns it when the
+    call is done; iter() keeps its connection until the iterator is
+    exhausted or closed.  Connections are opened lazily, at most
+    max_connections at the same time.  Callers wait for a free connection,
+    up to wait_timeout seconds if it is not None, after which PoolTimeout
+    is raised.  Idle connections are re-validated by the usual
+    max_idle_time check of Connection; with keepalive_interval a background
+    thread also pings connections that stay idle that long, so dead
+    sockets are replaced before a caller gets them.  All other arguments
+    are passed to Connection.
+    """
+    def __init__(self, host, database, user=None, password=None,
+                 max_connections=10, wait_timeout=None, **kwargs):
+        if max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+        self.host = host
+        self.database = database
+        self.max_connections = max_connections
+        self.wait_timeout = wait_timeout
+        self._connection_args = (host, database, user, password)
+        self._connection_kwargs = kwargs
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_in_use = 0
+        self._saturated = 0
+        self._connections = set()
+        self._closed = threading.Event()
+        keepalive_interval = kwargs.get("keepalive_interval")
+        if keepalive_interval is not None:
+            closed = self._closed
+            pool_ref = weakref.ref(self, lambda ref: closed.set())
+            thread = threading.Thread(target=_keepalive,
+                                      args=(pool_ref, closed,
+                                            keepalive_interval))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        """Closes all idle connections of the pool."""
+        self._closed.set()
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._connections.difference_update(idle)
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        """Returns the pool statistics as a dict.  saturation is the share
+        of max_connections currently in use, saturated counts the checkouts
+        that left every connection in use.  reconnects and pings are the
+        totals of the pooled connections.
+        """
+        with self._cond:
+            in_use = self._size - len(self._idle)
+            return dict(size=self._size, idle=len(self._idle), in_use=in_use,
+                        reconnects=sum(c.reconnects for c in self._connections),
+                        pings=sum(c.pings for c in self._connections),
+                        max_in_use=self._max_in_use,
+                        max_connections=self.max_connections,
+                        saturation=in_use / self.max_connections,
+                        saturated=self._saturated,
+                        checkouts=self._checkouts, waits=self._waits,
+                        wait_time=self._wait_time)
+
+    def iter(self, query, *parameters, **kwparameters):
+        """Returns an iterator for the given query and parameters."""
+        connection = self._checkout()
+        try:
+            rows = connection.iter(query, *parameters, **kwparameters)
+            try:
+                for row in rows:
+                    yield row
+            finally:
+                rows.close()
+        finally:
+            self._checkin(connection)
+
+    def iter_compact(self, query, *parameters, **kwparameters):
+        """Like iter(), but yields CompactRow objects."""
+        connection = self._checkout()
+        try:
+            rows = connection.iter_compact(query, *parameters, **kwparameters)
+            try:
+                for row in rows:
+                    yield row
+            finally:
+                rows.close()
+        finally:
+            self._checkin(connection)
+
+    def iter_batches(self, query, parameters=(), batch_size=1000,
+                     format="rows"):
+        """Returns an iterator over batches of rows, see
+        Connection.iter_batches.
+        """
+        connection = self._checkout()
+        try:
+            batches = connection.iter_batches(query, parameters, batch_size,
+                                              format)
+            try:
+                for batch in batches:
+                    yield batch
+            finally:
+                batches.close()
+        finally:
+            self._checkin(connection)
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        """Returns Connection.pipeline() of a connection checked out until
+        the block ends.
+        """
+        connection = self._checkout()
+        try:
+            with connection.pipeline() as pipeline:
+                yield pipeline
+        finally:
+            self._checkin(connection)
+
+    query = _pooled("query")
+    query_compact = _pooled("query_compact")
+    cached_query = _pooled("cached_query")
+    get = _pooled("get")
+    cached_get = _pooled("cached_get")
+    execute = _pooled("execute")
+    execute_lastrowid = _pooled("execute_lastrowid")
+    execute_rowcount = _pooled("execute_rowcount")
+    executemany = _pooled("executemany")
+    executemany_lastrowid = _pooled("executemany_lastrowid")
+    executemany_rowcount = _pooled("executemany_rowcount")
+    executemany_chunked = _pooled("executemany_chunked")
+
+    update = delete = execute_rowcount
+    updatemany = executemany_rowcount
+
+    insert = execute_lastrowid
+    insertmany = executemany_lastrowid
+    insertmany_chunked = executemany_chunked
+
+    def _checkout(self):
+        start = time.time()
+        waited = False
+        with self._cond:
+            self._checkouts += 1
+            while not self._idle and self._size >= self.max_connections:
+                if not waited:
+                    waited = True
+                    self._waits += 1
+                if self.wait_timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = start + self.wait_timeout - time.time()
+                    if remaining <= 0:
+                        self._wait_time += time.time() - start
+                        raise PoolTimeout("No connection to %s free after %s "
+                                          "seconds" % (self.host,
+                                                       self.wait_timeout))
+                    self._cond.wait(remaining)
+            if waited:
+                self._wait_time += time.time() - start
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                connection = None
+                self._size += 1
+            in_use = self._size - len(self._idle)
+            self._max_in_use = max(self._max_in_use, in_use)
+            if in_use >= self.max_connections:
+                self._saturated += 1
+        if connection is None:
+            try:
+                connection = Connection(*self._connection_args,
+                                        **self._connection_kwargs)
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._connections.add(connection)
+        return connection
+
+    def _checkin(self, connection):
+        with self._cond:
+            self._idle.append(connection)
+            self._cond.notify()
+
+    def _ping_idle(self, interval):
+        # Takes the connections idle for at least interval seconds out of
+        # the pool, pings them and puts them back.
+        now = time.time()
+        with self._cond:
+            stale = [c for c in self._idle
+                     if now - c._last_use_time >= interval]
+            for connection in stale:
+                self._idle.remove(connection)
+        for connection in stale:
+            try:
+                connection.ping()
+            except Exception:
+                logging.error("Cannot reconnect to MySQL on %s", self.host,
+                              exc_info=True)
+            self._checkin(connection)
+
+
+def _keepalive(pool_ref, closed, interval):
+    # Body of the ConnectionPool keepalive thread.  It only holds a weak
+    # reference so that an unused pool can still be collected, which also
+    # stops the thread.
+    while not closed.wait(interval):
+        pool = pool_ref()
+        if pool is None:
+            return
+        pool._ping_idle(interval)
+        del pool
+
+
+# Client error codes of OperationalError that mean the server could not
+# be reached, as opposed to errors of the statement itself.
+_CONNECTION_ERRORS = frozenset((2002, 2003, 2005, 2006, 2013, 2055))
+
+# Statements that report the replication lag, newest first, and their lag
+# column.
+_REPLICA_STATUS = (("SHOW REPLICA STATUS", "Seconds_Behind_Source"),
+                   ("SHOW SLAVE STATUS", "Seconds_Behind_Master"))
+
+
+def _routed_read(name):
+    # Builds a RoutingConnection method that runs the ConnectionPool method
+    # of the same name on a replica, see RoutingConnection._read.
+    def method(self, *args, **kwargs):
+        return self._read(name, args, kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(Connection, name).__doc__
+    return method
+
+
+def _routed_write(name):
+    # Builds a RoutingConnection method that runs the ConnectionPool method
+    # of the same name on the primary and starts the sticky window.
+    def method(self, *args, **kwargs):
+        try:
+            return getattr(self.primary, name)(*args, **kwargs)
+        finally:
+            self._local.last_write = time.time()
+    method.__name__ = name
+    method.__doc__ = getattr(Connection, name).__doc__
+    return method
+
+
+class _Replica(object):
+    # A replica host of a RoutingConnection and its health.
+    def __init__(self, host, pool, weight):
+        self.host = host
+        self.pool = pool
+        self.weight = weight
+        self.down_until = 0.0
+        self.lag = None
+        self.lag_checked = 0.0
+        # Index into _REPLICA_STATUS of the statement the server supports.
+        self.status = 0
+        self.reads = 0
+        self.failures = 0
+
+
+class RoutingConnection(object):
+    """Splits reads and writes between a MySQL primary and its replicas.
+    Typical usage::
+        db = torndb.RoutingConnection("db-primary", ["db-replica1",
+                                                     ("db-replica2", 2)],
+                                      "mydatabase", max_lag=10)
+        db.execute("UPDATE articles SET views = views + 1 WHERE id = %s", 1)
+        for article in db.query("SELECT * FROM articles"):
+            print article.title
+    query(), get(), iter() and the other reads go to a replica picked at
+    random in proportion to its weight (1 unless given as a (host, weight)
+    tuple); execute() and the other writes go to the primary.  Every host
+    has its own ConnectionPool, so the object is thread-safe; all other
+    arguments are passed to ConnectionPool.
+
+    For sticky_window seconds after a write, reads of the same thread go to
+    the primary as well, so a handler always sees its own writes.  A
+    replica that cannot be reached is skipped for retry_interval seconds
+    and the read is retried on another replica, or on the primary if none
+    is left (iterators are not retried, rows may already have been
+    yielded).  With max_lag, the replication lag of each replica is looked
+    up with SHOW REPLICA STATUS (or SHOW SLAVE STATUS on servers before
+    MySQL 8.0.22) at most every lag_check_interval seconds and
+    replicas lagging more than max_lag seconds (or not replicating at all)
+    are skipped until the next check.
+    """
+    def __init__(self, primary, replicas, database, user=None, password=None,
+                 sticky_window=1.0, max_lag=None, lag_check_interval=5.0,
+                 retry_interval=30.0, **kwargs):
+        self.sticky_window = sticky_window
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.retry_interval = retry_interval
+        self.primary = ConnectionPool(primary, database, user, password,
+                                      **kwargs)
+        self.replicas = []
+        for replica in replicas:
+            if isinstance(replica, tuple):
+                host, weight = replica
+            else:
+                host, weight = replica, 1
+            pool = ConnectionPool(host, database, user, password, **kwargs)
+            self.replicas.append(_Replica(host, pool, weight))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Closes all idle connections to all hosts."""
+        self.primary.close()
+        for replica in self.replicas:
+            replica.pool.close()
+
+    def stats(self):
+        """Returns the pool statistics of the primary and of every replica
+        together with its weight, health, last known lag and read count.
+        """
+        now = time.time()
+        return dict(primary=self.primary.stats(), replicas=dict(
+            (replica.host, dict(weight=replica.weight,
+                                healthy=replica.down_until <= now,
+                                lag=replica.lag, reads=replica.reads,
+                                failures=replica.failures,
+                                pool=replica.pool.stats()))
+            for replica in self.replicas))
+
+    def pipeline(self):
+        """Returns ConnectionPool.pipeline() of the primary within the
+        sticky window, else of a replica chosen like for other reads.  The
+        queries are not retried on another replica if it fails.
+        """
+        replica = self._choose(set())
+        if replica is None:
+            return self.primary.pipeline()
+        return replica.pool.pipeline()
+
+    query = _routed_read("query")
+    query_compact = _routed_read("query_compact")
+    cached_query = _routed_read("cached_query")
+    get = _routed_read("get")
+    cached_get = _routed_read("cached_get")
+    iter = _routed_read("iter")
+    iter_compact = _routed_read("iter_compact")
+    iter_batches = _routed_read("iter_batches")
+    execute = _routed_write("execute")
+    execute_lastrowid = _routed_write("execute_lastrowid")
+    execute_rowcount = _routed_write("execute_rowcount")
+    executemany = _routed_write("executemany")
+    executemany_lastrowid = _routed_write("executemany_lastrowid")
+    executemany_rowcount = _routed_write("executemany_rowcount")
+    executemany_chunked = _routed_write("executemany_chunked")
+
+    update = delete = execute_rowcount
+    updatemany = executemany_rowcount
+
+    insert = execute_lastrowid
+    insertmany = executemany_lastrowid
+    insertmany_chunked = executemany_chunked
+
+    def _read(self, name, args, kwargs):
+        tried = set()
+        while True:
+            replica = self._choose(tried)
+            if replica is None:
+                return getattr(self.primary, name)(*args, **kwargs)
+            tried.add(replica)
+            try:
+                return getattr(replica.pool, name)(*args, **kwargs)
+            except OperationalError as e:
+                if e.args[0] not in _CONNECTION_ERRORS:
+                    raise
+                self._mark_down(replica)
+
+    def _choose(self, tried):
+        # Picks a healthy replica not tried yet, None means the primary.
+        now = time.time()
+        last_write = getattr(self._local, "last_write", None)
+        if last_write is not None and now - last_write < self.sticky_window:
+            return None
+        candidates = [replica for replica in self.replicas
+                      if replica not in tried and replica.down_until <= now
+                      and self._fresh(replica, now)]
+        if not candidates:
+            return None
+        pick = random.random() * sum(r.weight for r in candidates)
+        for replica in candidates:
+            pick -= replica.weight
+            if pick < 0:
+                break
+        with self._lock:
+            replica.reads += 1
+        return replica
+
+    def _fresh(self, replica, now):
+        # Whether the replication lag of the replica is acceptable.  Only
+        # the first thread to notice that the lag is stale looks it up.
+        if self.max_lag is None:
+            return True
+        with self._lock:
+            check = now - replica.lag_checked >= self.lag_check_interval
+            if check:
+                replica.lag_checked = now
+        if check:
+            try:
+                replica.lag = self._lag(replica)
+            except DatabaseError as e:
+                if (isinstance(e, OperationalError) and e.args and
+                        e.args[0] in _CONNECTION_ERRORS):
+                    self._mark_down(replica)
+                    return False
+                # E.g. no REPLICATION CLIENT privilege: the lag is unknown
+                # and the replica is skipped until the next check.
+                logging.warning("Cannot look up the replication lag of MySQL "
+                                "replica %s: %s", replica.host, e)
+                replica.lag = None
+        return replica.lag is not None and replica.lag <= self.max_lag
+
+    def _lag(self, replica):
+        # The lag column is NULL while replication is stopped.
+        while True:
+            statement, column = _REPLICA_STATUS[replica.status]
+            try:
+                rows = replica.pool.query(statement)
+                break
+            except ProgrammingError:
+                # A server before MySQL 8.0.22 does not know SHOW REPLICA
+                # STATUS, MySQL 8.4 no longer knows SHOW SLAVE STATUS.
+                if replica.status + 1 == len(_REPLICA_STATUS):
+                    raise
+                replica.status += 1
+        lags = [row.get(column) for row in rows]
+        if not lags:
+            return 0
+        if None in lags:
+            return None
+        return max(lags)
+
+    def _mark_down(self, replica):
+        logging.warning("MySQL replica %s is unreachable, skipping it for "
+                        "%s seconds", replica.host, self.retry_interval)
+        with self._lock:
+            replica.failures += 1
+            replica.down_until = time.time() + self.retry_interval
+
+
+def _async(name):
+    # Builds an AsyncConnection method that runs the ConnectionPool method
+    # of the same name in the thread pool and returns an awaitable.
+    def method(self, *args, **kwargs):
+        return self._run(getattr(self._pool, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(Connection, name).__doc__
+    return method
+
+
+class AsyncConnection(object):
+    """An asyncio interface to MySQL.  Every method of Connection is
+    available and returns an awaitable instead of blocking the event loop::
+        db = torndb.AsyncConnection("localhost", "mydatabase",
+                                    max_connections=10)
+        for article in await db.query("SELECT * FROM articles"):
+            print(article.title)
+        async for article in db.iter("SELECT * FROM articles"):
+            print(article.title)
+    The queries run on a ConnectionPool of real connections in a pool of
+    max_connections threads, so up to max_connections queries are in flight
+    at the same time.  A query waits on the event loop until one of the
+    max_connections connection slots is free and only then is handed to a
+    thread, so threads never block waiting for a connection held by an
+    iterator.  Results are the same Row objects the synchronous Connection
+    returns.  All other arguments are passed to ConnectionPool.
+    """
+    def __init__(self, host, database, user=None, password=None,
+                 max_connections=10, **kwargs):
+        if asyncio is None:
+            raise RuntimeError("AsyncConnection requires asyncio")
+        self.max_connections = max_connections
+        self._pool = ConnectionPool(host, database, user, password,
+                                    max_connections=max_connections,
+                                    **kwargs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_connections)
+        # Created on first use so that it belongs to the running loop.
+        self._slots = None
+
+    def close(self):
+        """Waits for running queries and closes all connections."""
+        self._executor.shutdown(wait=True)
+        self._pool.close()
+
+    def stats(self):
+        """Returns the statistics of the underlying ConnectionPool."""
+        return self._pool.stats()
+
+    def iter(self, query, *parameters, **kwparameters):
+        """Returns an async iterator for the given query and parameters.
+        Rows are fetched in batches of 1000 in the thread pool.  The
+        connection is held until the iterator is exhausted, aclose() is
+        awaited or the iterator is garbage collected.
+        """
+        return _AsyncRowIterator(self, "iter", (query,) + parameters,
+                                 kwparameters)
+
+    def iter_compact(self, query, *parameters, **kwparameters):
+        """Like iter(), but yields CompactRow objects."""
+        return _AsyncRowIterator(self, "iter_compact",
+                                 (query,) + parameters, kwparameters)
+
+    def iter_batches(self, query, parameters=(), batch_size=1000,
+                     format="rows"):
+        """Returns an async iterator over batches of rows, see
+        Connection.iter_batches.  Every batch is read in the thread pool.
+        """
+        return _AsyncRowIterator(self, "iter_batches",
+                                 (query, parameters, batch_size, format), {},
+                                 batch_size=1)
+
+    def pipeline(self):
+        """Returns a pipeline like Connection.pipeline whose queries run
+        on one pooled connection when the block ends::
+            async with db.pipeline() as pipeline:
+                pipeline.get("SELECT * FROM users WHERE id = %s", user_id)
+                pipeline.query("SELECT * FROM articles LIMIT 10")
+            user, articles = pipeline.results
+        Without async with, await pipeline.execute() runs the queries.
+        """
+        return _AsyncPipeline(self)
+
+    def _submit(self, func, *args, **kwargs):
+        # Runs func in the thread pool, the caller holds a connection slot.
+        return asyncio.wrap_future(
+            self._executor.submit(func, *args, **kwargs))
+
+    def _acquire(self, start):
+        # Calls start() once a connection slot is free and returns a future
+        # of the result of the future start() returns.  Whoever start()
+        # hands the slot to has to release it.
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        slots = self._slots
+        acquire = asyncio.ensure_future(slots.acquire())
+        result = asyncio.Future()
+
+        def acquired(future):
+            if future.cancelled():
+                return
+            if result.done():
+                # Cancelled by the caller while waiting for the slot.
+                slots.release()
+                return
+            try:
+                inner = start()
+            except Exception as e:
+                slots.release()
+                result.set_exception(e)
+                return
+            _chain_future(inner, result)
+
+        acquire.add_done_callback(acquired)
+        result.add_done_callback(lambda future: acquire.cancel())
+        return result
+
+    def _release(self):
+        self._slots.release()
+
+    def _run(self, func, *args, **kwargs):
+        def start():
+            future = self._submit(func, *args, **kwargs)
+            future.add_done_callback(lambda future: self._release())
+            return future
+        return self._acquire(start)
+
+    query = _async("query")
+    query_compact = _async("query_compact")
+    cached_query = _async("cached_query")
+    get = _async("get")
+    cached_get = _async("cached_get")
+    execute = _async("execute")
+    execute_lastrowid = _async("execute_lastrowid")
+    execute_rowcount = _async("execute_rowcount")
+    executemany = _async("executemany")
+    executemany_lastrowid = _async("executemany_lastrowid")
+    executemany_rowcount = _async("executemany_rowcount")
+    executemany_chunked = _async("executemany_chunked")
+
+    update = delete = execute_rowcount
+    updatemany = executemany_rowcount
+
+    insert = execute_lastrowid
+    insertmany = executemany_lastrowid
+    insertmany_chunked = executemany_chunked
+
+
+def _chain_future(source, destination):
+    # Copies the outcome of the asyncio future source to destination.
+    def done(future):
+        if destination.done():
+            return
+        if future.cancelled():
+            destination.cancel()
+        elif future.exception() is not None:
+            destination.set_exception(future.exception())
+        else:
+            destination.set_result(future.result())
+    source.add_done_callback(done)
+
+
+class _AsyncRowIterator(object):
+    """Async iterator over a server side cursor, see AsyncConnection.iter.
+    A connection slot is acquired before the first fetch and held until
+    the connection is returned to the pool.
+    """
+    def __init__(self, owner, method, args, kwargs, batch_size=1000):
+        self._owner = owner
+        self._method = method
+        self._args = args
+        self._kwargs = kwargs
+        self.batch_size = batch_size
+        self._slot = False
+        self._loop = None
+        self._connection = None
+        self._rows = None
+        self._buffer = collections.deque()
+        self._done = False
+
+    def __del__(self):
+        # An iterator that is dropped without being exhausted or closed,
+        # e.g. by a break out of an async for loop, gives its connection
+        # and slot back like the generator of ConnectionPool.iter.  This
+        # may run in any thread, the slot is freed on the event loop.
+        if not self._slot:
+            return
+        owner, loop = self._owner, self._loop
+        rows, connection = self._rows, self._connection
+
+        def release():
+            try:
+                if rows is not None:
+                    rows.close()
+                if connection is not None:
+                    owner._pool._checkin(connection)
+            finally:
+                try:
+                    loop.call_soon_threadsafe(owner._release)
+                except RuntimeError:
+                    pass  # The loop is closed.
+
+        try:
+            owner._executor.submit(release)
+        except RuntimeError:
+            pass  # The AsyncConnection is closed.
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self._buffer:
+            future = asyncio.Future()
+            future.set_result(self._buffer.popleft())
+            return future
+        if self._done:
+            raise StopAsyncIteration
+        if self._slot:
+            return self._submit(self._fetch)
+        return self._owner._acquire(self._start)
+
+    def aclose(self):
+        """Releases the connection if the iterator was not exhausted."""
+        self._done = True
+        self._buffer.clear()
+        if not self._slot:
+            future = asyncio.Future()
+            future.set_result(None)
+            return future
+        return self._submit(self._release)
+
+    def _start(self):
+        self._slot = True
+        self._loop = asyncio.get_event_loop()
+        return self._submit(self._fetch)
+
+    def _submit(self, func):
+        # Only slot holders use threads, so there is always a free thread
+        # for the holder of a slot.
+        future = self._owner._submit(func)
+        future.add_done_callback(self._released)
+        return future
+
+    def _released(self, future):
+        # Runs on the event loop, frees the slot once the connection is
+        # back in the pool.
+        if self._slot and self._connection is None:
+            self._slot = False
+            self._owner._release()
+
+    def _fetch(self):
+        # Runs in the thread pool.
+        try:
+            if self._rows is None:
+                self._connection = self._owner._pool._checkout()
+                self._rows = getattr(self._connection, self._method)(
+                    *self._args, **self._kwargs)
+            batch = list(itertools.islice(self._rows, self.batch_size))
+        except Exception:
+            self._done = True
+            self._release()
+            raise
+        if len(batch) < self.batch_size:
+            self._done = True
+            self._release()
+        if not batch:
+            raise StopAsyncIteration
+        self._buffer.extend(batch[1:])
+        return batch[0]
+
+    def _release(self):
+        if self._rows is not None:
+            self._rows.close()
+            self._rows = None
+        if self._connection is not None:
+            self._owner._pool._checkin(self._connection)
+            self._connection = None
+
+
+class _AsyncPipeline(_Pipeline):
+    """Queued queries of AsyncConnection.pipeline."""
+    def __init__(self, owner):
+        _Pipeline.__init__(self, None)
+        self._owner = owner
+
+    def __enter__(self):
+        raise TypeError("use 'async with' with AsyncConnection.pipeline()")
+
+    def __aenter__(self):
+        future = asyncio.Future()
+        future.set_result(self)
+        return future
+
+    def __aexit__(self, type, value, traceback):
+        if type is None:
+            return self.execute()
+        future = asyncio.Future()
+        future.set_result(None)
+        return future
+
+    def execute(self):
+        """Runs the queued queries on a pooled connection and returns an
+        awaitable of their results, also stored in the results attribute.
+        """
+        queries, self._queries = self._queries, []
+        single, self._single = self._single, []
+        return self._owner._run(self._execute, queries, single)
+
+    def _execute(self, queries, single):
+        # Runs in the thread pool.
+        pool = self._owner._pool
+        connection = pool._checkout()
+        try:
+            self.results = _Pipeline._run(connection, queries, single)
+        finally:
+            pool._checkin(connection)
+        return self.results
 
 
 class Row(dict):
@@ -238,6 +1779,67 @@ class Row(dict):
         except KeyError:
             raise AttributeError(name)
 
+
+class CompactRow(object):
+    """A read-only row that keeps its values in a tuple and shares the
+    column name to position map with all rows of the same result set.
+    Supports ``row.name`` and ``row["name"]`` like Row; use ``dict(row)``
+    to get a Row-like dict.
+    """
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index, values):
+        object.__setattr__(self, "_index", index)
+        object.__setattr__(self, "_values", values)
+
+    @staticmethod
+    def index(description):
+        """Returns the column index map for a cursor description."""
+        return dict((d[0], i) for i, d in enumerate(description))
+
+    def __getitem__(self, name):
+        return self._values[self._index[name]]
+
+    def __getattr__(self, name):
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompactRow is read-only")
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __eq__(self, other):
+        return dict(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "CompactRow(%r)" % dict(self)
+
+    def get(self, name, default=None):
+        i = self._index.get(name)
+        return default if i is None else self._values[i]
+
+    def keys(self):
+        return sorted(self._index, key=self._index.get)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self.keys(), self._values))
+
 if MySQLdb is not None:
     # Fix the access conversions to properly recognize unicode/binary
     FIELD_TYPE = MySQLdb.constants.FIELD_TYPE
@@ -251,6 +1853,10 @@ if MySQLdb is not None:
     for field_type in field_types:
         CONVERSIONS[field_type] = [(FLAG.BINARY, str)] + CONVERSIONS[field_type]
 
+    _TEXT_TYPES = frozenset(field_types)
+
     # Alias some common MySQL exceptions
     IntegrityError = MySQLdb.IntegrityError
-    OperationalError = MySQLdb.OperationalError
\ No newline at end of file
+    OperationalError = MySQLdb.OperationalError
+    ProgrammingError = MySQLdb.ProgrammingError
+    DatabaseError = MySQLdb.DatabaseError
\ No newline at end of file